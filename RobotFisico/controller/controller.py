@@ -1,7 +1,20 @@
 from enum import Enum
 from json import loads, dumps
 from paho.mqtt.client import Client
-from math import cos, radians, sqrt, copysign, degrees, atan2
+from math import cos, sin, sqrt, radians, degrees, atan2
+from threading import Condition, Event, Lock, Thread
+from collections import deque
+from bisect import bisect_left
+from contextlib import redirect_stdout
+from io import StringIO
+from statistics import median
+from argparse import ArgumentParser
+from random import Random
+from timeit import repeat
+import time
+import numpy as np
+from planner import GridPlanner
+from occupancy import OccupancyGrid
 
 
 class Mode(Enum):
@@ -20,6 +33,34 @@ class Command(Enum):
     STOP = -1
 
 
+# Velocità (lineare in m/s, angolare in rad/s) con cui il kobuki esegue ogni comando
+# IMPORTANTE: devono essere uguali a quelle impostate nel modulo movimento (raspberry-pi/movimento-ISRLAB)
+COMMAND_VELOCITIES = {
+    Command.LEFT: (0, 0.3),
+    Command.FRONTLEFT: (0.1, 0.2),
+    Command.FRONT: (0.1, 0),
+    Command.FRONTRIGHT: (0.1, -0.2),
+    Command.RIGHT: (0, -0.3),
+    Command.SLOW_LEFT: (0, 0.2),
+    Command.SLOW_RIGHT: (0, -0.2),
+    Command.STOP: (0, 0),
+}
+
+# Direzione (in gradi, positiva a sinistra) rispetto all'orientamento del robot in cui guarda ogni sensore
+SENSOR_ANGLES = {
+    Command.LEFT: 90,
+    Command.FRONTLEFT: 45,
+    Command.FRONT: 0,
+    Command.FRONTRIGHT: -45,
+    Command.RIGHT: -90,
+}
+
+# Comandi su cui viene calcolata la tabella dell'obstacle avoidance, in posizione value + 1 (STOP, LEFT, ..., RIGHT)
+AVOIDANCE_COMMANDS = [Command.STOP, Command.LEFT, Command.FRONTLEFT, Command.FRONT, Command.FRONTRIGHT, Command.RIGHT]
+# Valore della maschera degli spazi liberi finché non arriva la prima perception (i bit 0-4 sono le direzioni libere)
+UNKNOWN_FREE_SPACES = 32
+
+
 class Constants:
     ROBOT_RADIUS = 0.2
     BROKER_HOSTNAME = "mosquitto"  # hostname del broker indicato nel docker-compose.yml
@@ -27,184 +68,261 @@ class Constants:
     PASSWORD = "contr_module"
     PORT = 1883
     LONG_DISTANCE = 0.4  # IMPORTANTE: deve essere uguale alla long distance nel perception
+    MIN_TAG_DISTANCE = 0.05  # m, distanza minima usata per pesare i tag, così un tag molto vicino non annulla gli altri
+    CONTROL_RATE = 10  # Hz, frequenza del ciclo di controllo che naviga verso il target in modalità automatica
+    # Peso della posa misurata dai tag rispetto a quella stimata dai comandi (1 = si usa solo la misura)
+    TAG_CORRECTION_GAIN = 0.7
+    # s, per quanto tempo senza tag si continua a navigare con la posa stimata prima di ruotare per cercare i tag
+    MAX_DEAD_RECKONING_TIME = 2.0
+    CAMERA_FOV = 62.2  # gradi, campo visivo orizzontale della camera (IMPORTANTE: deve essere uguale a quello nel modulo tags)
+    MAX_TAG_DISTANCE = 1.0  # m, distanza oltre la quale un tag non viene più riconosciuto in modo affidabile
+    MAX_SEARCH_TRANSLATION = 0.3  # m, massimo spostamento in avanti per avvicinarsi a un tag durante la ricerca
+    GRID_RESOLUTION = 0.05  # m, lato delle celle della griglia usata per pianificare il percorso verso il target
+    # m, distanza dal centro del robot a cui viene segnato sulla griglia l'ostacolo che occupa una direzione
+    OBSTACLE_MAP_DISTANCE = ROBOT_RADIUS + LONG_DISTANCE / 2
+    SONAR_MAX_RANGE = 1.0  # m, oltre questa distanza le letture dei sonar indicano solo spazio libero
+    SONAR_CONE_ANGLE = 42  # gradi, ampiezza del settore su cui il modulo sensor calcola la distanza minima
+    # File .npy in cui viene salvata periodicamente la griglia di occupazione e da cui viene ripresa all'avvio (None per disattivare)
+    OCCUPANCY_SNAPSHOT_FILE = "occupancy.npy"
+    OCCUPANCY_SNAPSHOT_PERIOD = 5  # s
+    # File di testo con una riga "ID x y" per ogni tag; se None i tag vengono disposti a griglia ogni space_between_tags
+    TAGS_LAYOUT_FILE = None
+
+
+# Un elemento per ogni tag, indicizzato direttamente con l'ID: posizione nell'arena e ultima rilevazione
+TAG_DTYPE = np.dtype([('x', np.float64), ('y', np.float64), ('dist', np.float64),
+                      ('yaw', np.float64), ('phi', np.float64), ('is_visible', np.bool_)])
 
 
 class Controller:
 
-    def __init__(self, targets: dict, arena_width: float = 2, arena_height: float = 2, space_between_tags: float = 0.5):
+    # Tabella di decisione dell'obstacle avoidance, costruita all'avvio da build_avoidance_table
+    _avoidance_table = None
+
+    def __init__(self, targets: dict, arena_width: float = 2, arena_height: float = 2, space_between_tags: float = 0.5,
+                 tags_layout: str = Constants.TAGS_LAYOUT_FILE, mqtt_client=None):
         self._mode = Mode.MANUAL
         self._free_spaces = dict()
+        self._free_mask = UNKNOWN_FREE_SPACES
         self._last_action = ""
         self._no_visible_tags = False
         self._reached = False
         # se diversa da "", allora significa che sto in una sessione di obstacle avoidance
         self._last_avoiding_command = ""
-        self._mqtt_manager = MqttManager(self)
+
+        # La decisione dell'obstacle avoidance dipende solo da ultimo comando, comando di avoiding, modalità e spazi
+        # liberi, quindi viene calcolata una volta per tutte le combinazioni
+        if (Controller._avoidance_table is None):
+            Controller._avoidance_table = Controller.build_avoidance_table()
+
+        self._mqtt_manager = MqttManager(self, mqtt_client)
 
         self._arena_size = (arena_width, arena_height)
         self._space_between_tags = space_between_tags
 
-        # Inizializzo il dizionario dei tag
-        self._tags = []
-        i = arena_height/2
-        while i >= -arena_height/2:
-            j = -arena_height/2
-            while j <= arena_height/2:
-                self._tags.append({
-                    'x': j,
-                    'y': i,
-                    'dist': 0,
-                    'yaw': 0,
-                    'phi': 0,
-                    'is_visible': False
-                })
-                j += self._space_between_tags
-            i -= self._space_between_tags
-
-        # for tag in enumerate(self._tags):
-        #     print(tag, flush=True)
+        # Inizializzo l'array dei tag e l'insieme degli ID visibili nell'ultimo messaggio
+        if tags_layout is not None:
+            self._tags = self.load_tags(tags_layout)
+        else:
+            self._tags = self.generate_tags(arena_height, space_between_tags)
+        self._visible_tags = set()
+        print(f"Tag conosciuti: {np.count_nonzero(~np.isnan(self._tags['x']))}", flush=True)
 
         self._my_pos = (0, 0)
         self._my_orientation = 0
 
+        # Tra una rilevazione dei tag e l'altra la posa viene stimata integrando la velocità del comando in esecuzione
+        # (dead reckoning); _pose_time è l'istante fino a cui è stata integrata, _last_fix_time quello dell'ultima
+        # posa misurata dai tag (None se la posa non è mai stata misurata)
+        self._velocity = COMMAND_VELOCITIES[Command.STOP]
+        self._pose_time = time.monotonic()
+        self._last_fix_time = None
+
+        # Ricerca dei tag in corso: comando di rotazione scelto, tag da inquadrare e spazio percorso in avanti
+        self._search_command = None
+        self._search_tag = None
+        self._search_start = None
+
         self._targets = targets
 
+        # Griglia di occupazione dell'arena su cui viene pianificato il percorso verso il target. Le celle vicine a un
+        # ostacolo meno del raggio del robot non sono attraversabili
+        self._planner = GridPlanner(arena_width, arena_height, Constants.GRID_RESOLUTION, Constants.ROBOT_RADIUS)
+
+        # Griglia di occupazione costruita con le distanze dei sonar, con la stessa risoluzione della griglia del
+        # planner. Le distanze sono misurate dal bordo del robot, quindi la portata dal centro è aumentata del raggio
+        self._occupancy = OccupancyGrid(arena_width, arena_height, Constants.GRID_RESOLUTION,
+                                        Constants.SONAR_MAX_RANGE + Constants.ROBOT_RADIUS, Constants.SONAR_CONE_ANGLE)
+        if (Constants.OCCUPANCY_SNAPSHOT_FILE is not None and self._occupancy.restore(Constants.OCCUPANCY_SNAPSHOT_FILE)):
+            print(f"Griglia di occupazione ripresa da {Constants.OCCUPANCY_SNAPSHOT_FILE}", flush=True)
+        self._last_snapshot = time.monotonic()
+        self.apply_occupancy()
+
+        # I target sono fissi: calcolo subito le distanze da ogni cella verso ognuno di essi e i percorsi tra i target
+        self._planner.precompute(list(self._targets.values()))
+
+        # Target ricevuto da gesture in modalità automatica (None se non ce n'è uno da raggiungere) e numero di
+        # sequenza dell'ultimo messaggio accettato, per scartare le copie ripetute consegnate con QoS 1
+        self._auto_target = None
+        self._auto_seq = -1
+
+        # Il ciclo di controllo e la gestione dei messaggi MQTT girano su thread diversi e condividono lo stato
+        self._lock = Lock()
+
         # Invio della prima operazione all'avvio (stop)
         self._last_command = Command.STOP
         self.exec_command(Command.STOP)
 
-        self._mqtt_manager._client.loop_forever()
+        Thread(target=self.control_loop, daemon=True).start()
 
-    def update_pos_and_orient(self):
+        self._mqtt_manager._client.loop_forever()
 
-        # Restituisce il tag visibile
-        tag = [tag for tag in self._tags if tag['is_visible'] == True][0]
+    def control_loop(self):
+        # Esegue un passo di navigazione a frequenza fissa, indipendentemente dalla frequenza dei messaggi ricevuti
+        period = 1 / Constants.CONTROL_RATE
+        next_tick = time.monotonic()
+        while True:
+            # Un errore in un passo non deve fermare il ciclo, altrimenti il robot non verrebbe più controllato
+            try:
+                with self._lock:
+                    self.predict_pose()
+
+                    # Se in questo periodo non sono arrivati tag, comunico la posa stimata
+                    if (self._mode == Mode.AUTO and not self._visible_tags):
+                        self.publish_pose()
+
+                    if (self._mode == Mode.AUTO and self._auto_target is not None):
+                        self.navigate_to_target()
+
+                    if (Constants.OCCUPANCY_SNAPSHOT_FILE is not None and
+                            time.monotonic() - self._last_snapshot >= Constants.OCCUPANCY_SNAPSHOT_PERIOD):
+                        self._occupancy.snapshot(Constants.OCCUPANCY_SNAPSHOT_FILE)
+                        self._last_snapshot = time.monotonic()
+            except Exception as e:
+                print(f"Passo del ciclo di controllo fallito: {e!r}", flush=True)
+
+            next_tick += period
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+    @staticmethod
+    def generate_tags(arena_height, space_between_tags):
+        ##
+        # Griglia di tag ogni space_between_tags metri: gli ID partono dalla riga in alto (y = arena_height/2) e
+        # scorrono ogni riga da sinistra (x = -arena_height/2) verso destra. Come nella disposizione originale
+        # l'arena è considerata quadrata di lato arena_height. Il numero di righe è calcolato con una tolleranza
+        # invece che accumulando il passo, così gli errori di arrotondamento non fanno perdere l'ultima riga
+        ##
+        count = int(np.floor(arena_height / space_between_tags + 1e-9)) + 1
+        steps = np.arange(count) * space_between_tags
+
+        tags = np.zeros(count * count, dtype=TAG_DTYPE)
+        tags['y'] = np.repeat(arena_height/2 - steps, count)
+        tags['x'] = np.tile(-arena_height/2 + steps, count)
+        return tags
+
+    @staticmethod
+    def load_tags(path):
+        # Ogni riga del file contiene "ID x y"; gli ID non elencati restano sconosciuti (posizione NaN)
+        layout = np.loadtxt(path, ndmin=2)
+        ids = layout[:, 0].astype(np.int64)
+
+        tags = np.zeros(ids.max() + 1, dtype=TAG_DTYPE)
+        tags['x'] = np.nan
+        tags['y'] = np.nan
+        tags['x'][ids] = layout[:, 1]
+        tags['y'][ids] = layout[:, 2]
+        return tags
 
+    def update_pos_and_orient(self):
         ##
-        # Calcolo posizione della camera
+        # Ogni tag visibile dà una stima della posa del robot, calcolata per tutti i tag insieme con operazioni vettoriali.
+        # Con yaw e phi in gradi, la camera si trova in (x + dist * sin(yaw), y - dist * cos(yaw)) rispetto al tag e il
+        # robot è orientato di 90 + yaw - phi gradi; il centro del robot è ROBOT_RADIUS dietro la camera lungo
+        # l'orientamento. Le stime vengono poi combinate con una media pesata (minimi quadrati pesati) in cui ogni tag
+        # pesa 1/dist^2, perché i tag più lontani sono misurati con meno precisione. L'orientamento viene mediato
+        # sui vettori unitari, così non ci sono discontinuità a ±180 gradi
         ##
+        if not self._visible_tags:
+            return
 
-        # Aggiungo la distanza tra la fotocamera e il centro del robot
-        if (tag['dist'] == None):
+        tags = self._tags[np.fromiter(self._visible_tags, dtype=np.int64, count=len(self._visible_tags))]
+        tags = tags[~np.isnan(tags['dist'])]
+        if len(tags) == 0:
             return
 
-        dist = round(tag['dist'], 3)
-        yaw = round(tag['yaw'], 3)
-        camera_x = tag['x']
-        camera_y = tag['y']
-
-        # Calcolo dell'angolo vicino all'origine del triangolo rettangolo
-        beta = (abs(yaw) % 90)
-        if (beta != 0):
-            # Calcolo dei cateti
-            a = dist * cos(radians(beta))
-            b = sqrt(dist ** 2 - a ** 2)
-            if (yaw >= -90 and yaw <= 90):
-                camera_x += copysign(1, yaw) * b
-                camera_y -= a
-            else:
-                camera_x += copysign(1, yaw) * a
-                camera_y += b
-        else:
-            # tratto separatamente i casi limite
-            if (yaw == 0):
-                camera_y -= dist
-            elif (yaw == 90):
-                camera_x += dist
-            elif (abs(yaw) == 180):
-                camera_y += dist
-            else:
-                camera_x -= dist
+        yaw = np.radians(tags['yaw'])
+        camera_x = tags['x'] + tags['dist'] * np.sin(yaw)
+        camera_y = tags['y'] - tags['dist'] * np.cos(yaw)
+        orientation = yaw + np.radians(90 - tags['phi'])
 
-        camera_x = round(camera_x, 3)
-        camera_y = round(camera_y, 3)
+        weights = 1 / np.maximum(tags['dist'], Constants.MIN_TAG_DISTANCE) ** 2
+        weights /= weights.sum()
 
-        ##
-        # Calcolo orientamento
-        ##
-        my_or = 0
-        phi = tag['phi']
-        gamma = abs(yaw)
-        if (abs(yaw) % 90 != 0):
-            if (gamma > 90):
-                gamma = 180 - gamma
-            theta = 90 - gamma
-
-            if (yaw > -180 and yaw < -90):
-                my_or = -theta - phi
-            elif (yaw > 90 and yaw < 180):
-                my_or = -180 + theta - phi
-            elif (yaw > -90 and yaw < 0):
-                my_or = theta - phi
-            elif (yaw > 0 and yaw < 90):
-                my_or = 180 - theta - phi
-            else:
-                print("Caso errato, verificare il problema", flush=True)
-        # tratto separatamente i casi limite
-        else:
-            if (yaw == 0):
-                my_or = 90 - phi
-            elif (yaw == 90):
-                # a seconda del segno di phi parto da 180 o -180
-                my_or = phi/abs(phi) * 180 - phi
-            elif (yaw == 180 or yaw == -180):
-                my_or = -90 - phi
-            elif (yaw == -90):
-                my_or = -phi
-            else:
-                print(
-                    "Caso limite errato, verificare il problema", flush=True)
+        my_or = atan2(weights @ np.sin(orientation), weights @ np.cos(orientation))
 
-        my_or = round(my_or, 3)
-        self._my_orientation = my_or
-        ##
         # Una volta calcolata la posizione della camera, la traslo rispetto alla distanza del robot
-        ##
-        vertical_leg = 0
-        # Il segno per cui deve essere moltiplicato horizontal_leg prima di essere sommato alla x
-        horizontal_sign = 1
+        measured_pos = (float(weights @ camera_x) - Constants.ROBOT_RADIUS * cos(my_or),
+                        float(weights @ camera_y) - Constants.ROBOT_RADIUS * sin(my_or))
 
-        if (abs(my_or) == 90):
-            self._my_pos = (camera_x, camera_y +
-                            copysign(1, my_or) * Constants.ROBOT_RADIUS)
+        self.correct_pose(measured_pos, degrees(my_or))
 
-        elif (abs(my_or) == 180):
-            self._my_pos = (camera_x - Constants.ROBOT_RADIUS, camera_y)
+        # print("New position: " + str(self._my_pos) +
+        #       ", new orientation: "+str(self._my_orientation), flush=True)
+
+        # Comunico a gesture la nuova posizione in modo da stamparla sull'interfaccia
+        self.publish_pose()
 
-        elif (my_or == 0):
-            self.my_pos = self._my_pos = (
-                camera_x + Constants.ROBOT_RADIUS, camera_y)
+    def predict_pose(self):
+        ##
+        # Porta la posa all'istante attuale integrando la velocità del comando in esecuzione dall'ultimo
+        # aggiornamento. Con velocità angolare non nulla il robot percorre un arco di circonferenza, che viene
+        # integrato in forma chiusa così il risultato non dipende dalla frequenza con cui viene chiamata
+        ##
+        now = time.monotonic()
+        dt = now - self._pose_time
+        self._pose_time = now
+
+        vx, wz = self._velocity
+        if (dt <= 0 or (vx == 0 and wz == 0)):
             return
 
-        elif (my_or < -90 and my_or > -180):
-            vertical_leg = Constants.ROBOT_RADIUS * \
-                cos(radians(abs(my_or) - 90))  # Segno positivo
+        my_x, my_y = self._my_pos
+        start = radians(self._my_orientation)
+        end = start + wz * dt
+        if (wz == 0):
+            my_x += vx * dt * cos(start)
+            my_y += vx * dt * sin(start)
+        else:
+            my_x += vx / wz * (sin(end) - sin(start))
+            my_y -= vx / wz * (cos(end) - cos(start))
+
+        self._my_pos = (my_x, my_y)
+        self._my_orientation = (degrees(end) + 540) % 360 - 180
 
-        elif (my_or < 0 and my_or > -90):
-            vertical_leg = Constants.ROBOT_RADIUS * \
-                cos(radians(90 - abs(my_or)))  # Segno positivo
-            horizontal_sign = -1
+    def correct_pose(self, measured_pos, measured_orientation):
+        ##
+        # Filtro complementare: la posa stimata viene avvicinata a quella misurata dai tag di TAG_CORRECTION_GAIN.
+        # Se la posa non è mai stata misurata o la stima è troppo vecchia viene sostituita direttamente dalla misura
+        ##
+        self.predict_pose()
 
-        elif (my_or > 0 and my_or < 90):
-            vertical_leg = -1 * Constants.ROBOT_RADIUS * \
-                cos(radians(90 - my_or))  # Segno negativo
-            horizontal_sign = -1
+        gain = Constants.TAG_CORRECTION_GAIN
+        if (self._last_fix_time is None or self._pose_time - self._last_fix_time > Constants.MAX_DEAD_RECKONING_TIME):
+            gain = 1
 
-        elif (my_or > 90 and my_or < 180):
-            vertical_leg = -1 * Constants.ROBOT_RADIUS * \
-                cos(radians(my_or - 90))  # Segno negativo
+        my_x, my_y = self._my_pos
+        self._my_pos = (my_x + gain * (measured_pos[0] - my_x),
+                        my_y + gain * (measured_pos[1] - my_y))
 
-        horizontal_leg = horizontal_sign * \
-            sqrt(Constants.ROBOT_RADIUS ** 2 - vertical_leg ** 2)
-        self._my_pos = (round(camera_x + horizontal_leg, 3),
-                        round(camera_y + vertical_leg, 3))
+        variation = (measured_orientation - self._my_orientation + 540) % 360 - 180
+        self._my_orientation = (self._my_orientation + gain * variation + 540) % 360 - 180
 
-        # print("New position: " + str(self._my_pos) +
-        #       ", new orientation: "+str(self._my_orientation), flush=True)
+        self._last_fix_time = self._pose_time
 
-        # Comunico a gesture la nuova posizione in modo da stamparla sull'interfaccia
+    def publish_pose(self):
         self._mqtt_manager._client.publish(
-            "/position", dumps({"position": self._my_pos, "orientation": self._my_orientation}))
+            "/position", dumps({"position": (round(self._my_pos[0], 3), round(self._my_pos[1], 3)),
+                                "orientation": round(self._my_orientation, 3)}))
 
     def exec_command(self, command: Command):
 
@@ -214,6 +332,10 @@ class Controller:
             self._mqtt_manager._client.publish("/actions", command.value)
             self._last_action = command
 
+            # Integro la posa con la velocità precedente fino a questo istante, poi uso quella del nuovo comando
+            self.predict_pose()
+            self._velocity = COMMAND_VELOCITIES[command]
+
     def check_free_spaces(self, cmnd1: Command, cmnd2: Command, cmnd3: Command, cmnd4: Command):
         ##
         # In questa funzione vengono passati i comandi nell'ordine in cui voglio che siano valutati
@@ -231,6 +353,52 @@ class Controller:
         return Command.STOP
 
     def avoid_obstacles(self):
+        # Il risultato e il nuovo comando di avoiding sono letti dalla tabella invece di rieseguire avoid_obstacles_reference.
+        # Uso _value_ invece di value perché value è una property dell'Enum e costa più dell'intera ricerca in tabella
+        command_index = self._last_command._value_ + 1
+        if (command_index >= len(AVOIDANCE_COMMANDS)):
+            return self.avoid_obstacles_reference()
+        avoiding_index = 0 if self._last_avoiding_command == "" else self._last_avoiding_command._value_ + 1
+
+        command, self._last_avoiding_command = Controller._avoidance_table[
+            ((command_index * 6 + avoiding_index) * 2 + self._mode._value_ - 1) * 33 + self._free_mask]
+        return command
+
+    @staticmethod
+    def build_avoidance_table():
+        ##
+        # Esegue avoid_obstacles_reference per ogni combinazione di ultimo comando, comando di avoiding ("" o una
+        # delle cinque direzioni), modalità e maschera degli spazi liberi (32 combinazioni più "non inizializzati"),
+        # salvando il comando restituito e il comando di avoiding risultante. L'indice è quello usato in avoid_obstacles
+        ##
+        probe = Controller.__new__(Controller)
+        table = []
+        for last_command in AVOIDANCE_COMMANDS:
+            for last_avoiding_command in [""] + AVOIDANCE_COMMANDS[1:]:
+                for mode in Mode:
+                    for mask in range(UNKNOWN_FREE_SPACES + 1):
+                        probe._last_command = last_command
+                        probe._last_avoiding_command = last_avoiding_command
+                        probe._mode = mode
+                        probe._free_spaces = Controller.free_spaces_from_mask(mask)
+                        command = probe.avoid_obstacles_reference()
+                        table.append((command, probe._last_avoiding_command))
+        return table
+
+    @staticmethod
+    def free_spaces_from_mask(mask):
+        if (mask == UNKNOWN_FREE_SPACES):
+            return dict()
+        return {command: bool(mask >> command.value & 1) for command in AVOIDANCE_COMMANDS[1:]}
+
+    @staticmethod
+    def mask_from_free_spaces(free_spaces):
+        if (len(free_spaces) < len(AVOIDANCE_COMMANDS) - 1):
+            return UNKNOWN_FREE_SPACES
+        return sum(1 << command.value for command in AVOIDANCE_COMMANDS[1:] if free_spaces[command])
+
+    def avoid_obstacles_reference(self):
+        # Logica originale dell'obstacle avoidance, usata per costruire la tabella di decisione e per verificarla
 
         # L'obstacle avoidance non viene fatta se l'ultimo comando è STOP
         if (self._last_command == Command.STOP):
@@ -333,46 +501,87 @@ class Controller:
         self.exec_command(command)
 
     def handle_auto_cmnd(self, decoded_msg: str):
-        if (decoded_msg == str(Command.STOP.value)):
+        # Il messaggio contiene il numero di sequenza e il target (o STOP), ed è pubblicato solo quando cambia
+        decoded_json = loads(decoded_msg)
+        if (decoded_json["seq"] <= self._auto_seq):
+            return
+        self._auto_seq = decoded_json["seq"]
+
+        if (decoded_json["target"] == str(Command.STOP.value)):
+            self._auto_target = None
             self._last_command = Command.STOP
             self.exec_command(Command.STOP)
 
         else:
-            # Se non vedo tags e non sono arrivato ancora all'obiettivo, allora non eseguo il comando
-            if (self._no_visible_tags and not self._reached):
-                return print(
-                    "Non vedo tags, attendi...", flush=True)
-            
-            # Se avevo raggiunto l'obiettivo e sono qui, significa che ho ricevuto un nuovo obiettivo
-            if(self._reached): self._reached = False
+            # Memorizzo il nuovo obiettivo, che verrà raggiunto dal ciclo di controllo, e ripulisco la griglia dagli
+            # ostacoli visti dal perception durante il percorso precedente, tenendo quelli accumulati con i sonar
+            self._auto_target = decoded_json["target"]
+            self._planner.clear_obstacles()
+            self.apply_occupancy()
+            self._reached = False
+            print("Nuovo target: " + self._auto_target, flush=True)
+
+    def navigate_to_target(self):
+        # Se non vedo tags e non sono arrivato ancora all'obiettivo, allora non eseguo il comando
+        if (self._no_visible_tags and not self._reached):
+            return
 
-            # Recupero dal dizionario la posizione da raggiungere
-            pos_to_reach = self._targets[decoded_msg]
+        # Recupero dal dizionario la posizione da raggiungere
+        pos_to_reach = self._targets[self._auto_target]
 
-            # Se mi sono avvicinato abbastanza all'obiettivo, mi fermo
-            if (self.close_enough(pos_to_reach)):
+        # Se mi sono avvicinato abbastanza all'obiettivo, mi fermo
+        if (self.close_enough(pos_to_reach)):
 
-                self._last_command = Command.STOP
-                self.exec_command(Command.STOP)
-                self._reached = True
+            self._last_command = Command.STOP
+            self.exec_command(Command.STOP)
+            self._reached = True
+            self._auto_target = None
 
-                # Avviso il modulo gesture che sono arrivato
-                self._mqtt_manager._client.publish(
-                    "/gesture_confirm", "reached")
-                print("\nReached\n", flush=True)
+            # Avviso il modulo gesture che sono arrivato
+            self._mqtt_manager._client.publish(
+                "/gesture_confirm", "reached", qos=1)
+            print("\nReached\n", flush=True)
 
-            else:
+        else:
+
+            # Imposta last command come la direzione migliore per raggiungere il prossimo punto del percorso
+            self.get_dir_to_target(
+                self.next_waypoint(pos_to_reach))
+
+            # Su tale direzione eseguo l'obstacle avoidance
+            command = self.avoid_obstacles()
 
-                # Imposta last command come la direzione migliore per avvicinarsi al target
-                self.get_dir_to_target(
-                    pos_to_reach)
+            # Eseguo il comando così calcolato
+            self.exec_command(
+                command)
 
-                # Su tale direzione eseguo l'obstacle avoidance
-                command = self.avoid_obstacles()
+    def next_waypoint(self, pos_to_reach):
+        # Seguo il campo di distanze del target (riparato dalla ricerca precedente) fino al primo punto più lontano del
+        # raggio del robot, così il robot non ruota sul posto verso punti che ha già raggiunto
+        waypoint = self._planner.next_point(self._my_pos, pos_to_reach, Constants.ROBOT_RADIUS)
 
-                # Eseguo il comando così calcolato
-                self.exec_command(
-                    command)
+        # Se sulla griglia il target non è raggiungibile mi dirigo direttamente verso di esso e lascio fare all'obstacle avoidance
+        if (waypoint is None):
+            return pos_to_reach
+        return waypoint
+
+    def update_map(self):
+        ##
+        # Segno sulla griglia un ostacolo davanti a ogni direzione occupata. Le direzioni libere non cancellano gli
+        # ostacoli già segnati (il rumore dei sensori farebbe cambiare il percorso ad ogni messaggio): la griglia viene
+        # svuotata quando arriva un nuovo target. Serve una posa affidabile, quindi la mappa viene aggiornata solo in
+        # modalità automatica con una posa misurata
+        ##
+        if (self._mode != Mode.AUTO or self._last_fix_time is None):
+            return
+
+        my_x, my_y = self._my_pos
+        for command, free in self._free_spaces.items():
+            if free:
+                continue
+            angle = radians(self._my_orientation + SENSOR_ANGLES[command])
+            self._planner.set_obstacle((my_x + Constants.OBSTACLE_MAP_DISTANCE * cos(angle),
+                                        my_y + Constants.OBSTACLE_MAP_DISTANCE * sin(angle)), True)
 
     def handle_perceptions(self, decoded_msg: str):
         # Aggiorno i freespaces
@@ -382,6 +591,10 @@ class Controller:
         for key, value in decoded_json.items():
             enum_key = Command[key]
             self._free_spaces[enum_key] = value
+        self._free_mask = self.mask_from_free_spaces(self._free_spaces)
+
+        # Riporto gli ostacoli sulla griglia, così il prossimo passo di navigazione ripianifica il percorso
+        self.update_map()
 
         # Verifico se con le nuove perceptions c'è bisogno di evitare un ostacolo
         command = self.avoid_obstacles()
@@ -390,31 +603,49 @@ class Controller:
         self.exec_command(command)
 
 
+    def handle_sensors(self, decoded_msg: str):
+        # Le distanze vanno riportate nell'arena, quindi servono una posa recente e la modalità automatica
+        if (self._mode != Mode.AUTO or not self.pose_is_recent()):
+            return
+
+        decoded_json = loads(decoded_msg)
+        distances = [decoded_json[command.name] + Constants.ROBOT_RADIUS for command in SENSOR_ANGLES]
+        cells, occupied = self._occupancy.update((*self._my_pos, self._my_orientation),
+                                                 list(SENSOR_ANGLES.values()), distances)
+
+        # Riporto sulla griglia del planner solo le celle che hanno cambiato stato
+        for point, is_occupied in zip(self._occupancy.to_points(cells), occupied):
+            self._planner.set_obstacle(point, bool(is_occupied))
+
+    def apply_occupancy(self):
+        for point in self._occupancy.to_points(self._occupancy.occupied_cells()):
+            self._planner.set_obstacle(point, True)
+
     def handle_tags(self, decoded_msg):
         # Se sono in modalità manuale non ho bisogno della posizione e dell'orientamento
         if (self._mode == Mode.MANUAL):
             self._no_visible_tags = False
             return
 
-        decoded_tag = loads(decoded_msg)
+        # Il messaggio contiene la lista di tutti i tag visti nel frame; accetto anche il vecchio formato con un solo tag (ID -1 se nessuno)
+        decoded_json = loads(decoded_msg)
+        if ("tags" in decoded_json):
+            detections = decoded_json["tags"]
+        else:
+            detections = [decoded_json] if int(decoded_json["ID"]) != -1 else []
 
         # Se non vedo tag, allora ruoto lentamente per trovare i marker nella direzione più prossima a quella in cui stavo andando
-        if (int(decoded_tag["ID"]) == -1):
+        if (not detections):
+            self.update_tags(detections)
 
-            # Controllo qual è l'ultimo comando che stavo eseguendo
-            command = self._last_command
-            if (self._last_avoiding_command != ""):
-                command = self._last_avoiding_command
+            # Se però la posa è stata misurata da poco continuo a navigare con la posa stimata dai comandi
+            if (not self._reached and self.pose_is_recent()):
+                return
 
-    
             if (self._reached):
                 self.exec_command(Command.STOP)
-            # Se l'ultimo comando è verso destra, ruoto lentamente verso destra
-            elif (command == Command.RIGHT or command == Command.FRONTRIGHT):
-                self.exec_command(Command.SLOW_RIGHT)
-            # Altrimenti ruoto lentamente verso sinistra
             else:
-                self.exec_command(Command.SLOW_LEFT)
+                self.exec_command(self.search_tags())
 
             # Tramite questa variabile, se arrivano altri comandi so già che non posso eseguirli perché non vedo tag
             self._no_visible_tags = True
@@ -424,50 +655,156 @@ class Controller:
         if(self._no_visible_tags):
             self.exec_command(Command.STOP)
             self._no_visible_tags = False
+        self._search_command = None
 
-        # Se invece vedo marker, aggiorno il dizionario
-        self.update_tags(decoded_tag)        
+        # Se invece vedo marker, aggiorno l'array dei tag
+        self.update_tags(detections)
 
         # Con i dati aggiornati posso aggiornare posizione ed orientamento
         self.update_pos_and_orient()
 
+    def search_tags(self):
+        ##
+        # Sceglie il comando con cui cercare i tag. Alla prima chiamata di una ricerca, usando la disposizione dei
+        # tag e l'ultima posa stimata, calcola per ogni tag conosciuto di quanto dovrebbe ruotare la camera a
+        # sinistra e a destra perché il tag entri nel campo visivo, e sceglie il tag e il verso più rapidi. Se nessun
+        # tag è abbastanza vicino da essere riconosciuto, sceglie il più vicino e, una volta inquadrato, avanza
+        # verso di esso di al più MAX_SEARCH_TRANSLATION. Nelle chiamate successive mantiene il verso scelto, così la
+        # rotazione non cambia verso ad ogni frame, e la posa viene aggiornata dal dead reckoning durante la rotazione
+        ##
+        if (self._search_command is None):
+            self.plan_search()
+            self._search_start = self._my_pos
+
+        # Se il tag scelto è già nel campo visivo ma troppo lontano, avanzo verso di esso se la strada è libera
+        if (self._search_tag is not None):
+            distance, rotation = self.tag_from_camera(self._search_tag)
+            travelled = sqrt((self._my_pos[0] - self._search_start[0]) ** 2 +
+                             (self._my_pos[1] - self._search_start[1]) ** 2)
+            if (abs(rotation) <= Constants.CAMERA_FOV/2 and distance > Constants.MAX_TAG_DISTANCE and
+                    travelled < Constants.MAX_SEARCH_TRANSLATION and self._free_spaces.get(Command.FRONT, True)):
+                return Command.FRONT
+
+        return self._search_command
+
+    def plan_search(self):
+        # Senza una posa misurata non posso usare la mappa dei tag: ruoto verso il lato dell'ultimo comando eseguito
+        command = self._last_command
+        if (self._last_avoiding_command != ""):
+            command = self._last_avoiding_command
+        self._search_command = Command.SLOW_RIGHT if command in (Command.RIGHT, Command.FRONTRIGHT) else Command.SLOW_LEFT
+        self._search_tag = None
+
+        if (self._last_fix_time is None):
+            return
+
+        ids = np.flatnonzero(~np.isnan(self._tags['x']))
+        if len(ids) == 0:
+            return
+        distances, rotations = self.tag_from_camera(ids)
+
+        # Angolo di cui ruotare a sinistra (positivo) e a destra perché il tag entri nel campo visivo. I tag che
+        # dovrebbero essere già inquadrati non sono stati visti, quindi vengono considerati dopo un giro completo
+        half_fov = Constants.CAMERA_FOV / 2
+        left = (rotations - half_fov) % 360
+        right = (-rotations - half_fov) % 360
+
+        # Preferisco i tag abbastanza vicini da essere riconosciuti; altrimenti considero il più vicino
+        in_range = distances <= Constants.MAX_TAG_DISTANCE
+        if (not in_range.any()):
+            in_range = distances == distances.min()
+
+        left = np.where(in_range, left, np.inf)
+        right = np.where(in_range, right, np.inf)
+        best_left, best_right = np.argmin(left), np.argmin(right)
+
+        # Le rotazioni lente a sinistra e a destra hanno la stessa velocità, quindi basta confrontare gli angoli
+        if (left[best_left] <= right[best_right]):
+            self._search_command = Command.SLOW_LEFT
+            self._search_tag = ids[best_left]
+        else:
+            self._search_command = Command.SLOW_RIGHT
+            self._search_tag = ids[best_right]
+
+    def tag_from_camera(self, ids):
+        # Distanza e angolo (in gradi, positivo a sinistra) dei tag rispetto alla camera, secondo la posa stimata
+        my_or = radians(self._my_orientation)
+        camera_x = self._my_pos[0] + Constants.ROBOT_RADIUS * cos(my_or)
+        camera_y = self._my_pos[1] + Constants.ROBOT_RADIUS * sin(my_or)
+
+        dx = self._tags['x'][ids] - camera_x
+        dy = self._tags['y'][ids] - camera_y
+        rotations = (np.degrees(np.arctan2(dy, dx)) - self._my_orientation + 540) % 360 - 180
+        return np.hypot(dx, dy), rotations
+
+    def pose_is_recent(self):
+        return (self._last_fix_time is not None and
+                time.monotonic() - self._last_fix_time <= Constants.MAX_DEAD_RECKONING_TIME)
+
     def change_mode(self, decoded_msg: str):
         self._mode = Mode[decoded_msg]
         print("Cambio modalità in " + str(self._mode.name), flush=True)
+
+        # Il target automatico vale solo nella sessione in cui è stato scelto: al cambio di modalità lo scarto e fermo
+        # il robot, altrimenti tornando in automatico il ciclo di controllo ripartirebbe verso il vecchio target
+        self._auto_target = None
+        self._last_command = Command.STOP
+        self._last_avoiding_command = ""
+        self.exec_command(Command.STOP)
         
-    def update_tags(self, received_tag):
-        new_tags_list = []
-        for i, tag in enumerate(self._tags):
-            new_tag = {'x': tag['x'], 'y': tag['y'], 'dist': None,
-                       'yaw': None, 'phi': None, 'is_visible': False}
-            if i == received_tag['ID']:
-                new_tag['dist'] = received_tag['dist']
-                new_tag['yaw'] = received_tag['yaw']
-                new_tag['phi'] = received_tag['phi']
-                new_tag['is_visible'] = True
-                # print(
-                #     f"\n\n ID:{str(received_tag['ID'])}, dist: {str(new_tag['dist'])}\n\n", flush=True)
-            new_tags_list.append(new_tag)
-
-        self._tags = new_tags_list
+    def update_tags(self, received_tags):
+        # Nascondo solo i tag visibili nel messaggio precedente invece di ricostruire l'intero array
+        for tag_id in self._visible_tags:
+            self._tags[tag_id]['is_visible'] = False
+        self._visible_tags.clear()
+
+        for received_tag in received_tags:
+            tag_id = int(received_tag['ID'])
+            if (tag_id < 0 or tag_id >= len(self._tags) or np.isnan(self._tags['x'][tag_id])):
+                print(f"Tag {tag_id} non presente nella disposizione dei tag", flush=True)
+                continue
+
+            self._tags[tag_id] = (self._tags['x'][tag_id], self._tags['y'][tag_id],
+                                  received_tag['dist'], received_tag['yaw'], received_tag['phi'], True)
+            self._visible_tags.add(tag_id)
 
 
 class MqttManager:
 
-    def __init__(self, controller: Controller):
-        self._client = Client(Constants.USERNAME)
-        self._client.username_pw_set(Constants.USERNAME, Constants.PASSWORD)
-        self._client.connect(Constants.BROKER_HOSTNAME, Constants.PORT)
+    # Topic di telemetria: conta solo l'ultimo messaggio, quelli non ancora gestiti vengono sostituiti dal nuovo
+    COALESCED_TOPICS = ("/tags", "/sensors")
+
+    def __init__(self, controller: Controller, client=None):
+        # Se ricevo un client già pronto (ad esempio quello in memoria usato dal benchmark) non mi connetto al broker
+        if client is not None:
+            self._client = client
+        else:
+            self._client = Client(Constants.USERNAME)
+            self._client.username_pw_set(Constants.USERNAME, Constants.PASSWORD)
+            self._client.connect(Constants.BROKER_HOSTNAME, Constants.PORT)
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
         self._controller = controller
 
+        ##
+        # I messaggi ricevuti vengono gestiti da un thread separato, così il thread di rete di paho non resta bloccato
+        # dietro un messaggio lento. Vengono gestiti prima i messaggi urgenti (perceptions e comandi di STOP) nell'ordine
+        # di arrivo, poi gli altri comandi nell'ordine di arrivo, infine l'ultimo messaggio di ogni topic di telemetria
+        ##
+        self._mailbox = Condition()
+        self._urgent = deque()
+        self._ordered = deque()
+        self._latest = dict()
+        Thread(target=self.dispatch_loop, daemon=True).start()
+
     def on_connect(self, client, userdata, flags, rc):
         print("Connected with result code " + str(rc), flush=True)
         self._client.subscribe("/commands_manual")
-        self._client.subscribe("/commands_auto")
+        # I target automatici sono pubblicati una sola volta, quindi li ricevo con QoS 1
+        self._client.subscribe("/commands_auto", qos=1)
         self._client.subscribe("/perceptions")
         self._client.subscribe("/tags")
+        self._client.subscribe("/sensors")
         self._client.subscribe("/mode")
 
     def on_message(self, client, rc, msg):
@@ -478,6 +815,60 @@ class MqttManager:
         if (decoded_msg == ""):
             return print("Messaggio vuoto")
 
+        with self._mailbox:
+            if (topic in self.COALESCED_TOPICS):
+                self._latest[topic] = decoded_msg
+            elif (self.is_urgent(topic, decoded_msg)):
+                ##
+                # I cambi di modalità ancora in coda vengono anticipati insieme allo STOP, che altrimenti verrebbe eseguito
+                # nella modalità precedente; i comandi ricevuti prima dello STOP sul suo topic e non ancora eseguiti
+                # vengono scartati, perché non devono far ripartire il robot dopo lo STOP
+                ##
+                if (topic != "/perceptions"):
+                    self._urgent.extend(message for message in self._ordered if message[0] == "/mode")
+                    self._ordered = deque(message for message in self._ordered if message[0] not in ("/mode", topic))
+                self._urgent.append((topic, decoded_msg))
+            else:
+                self._ordered.append((topic, decoded_msg))
+            self._mailbox.notify()
+
+    @staticmethod
+    def is_urgent(topic, decoded_msg):
+        if (topic == "/perceptions"):
+            return True
+        if (topic == "/commands_manual"):
+            return decoded_msg == str(Command.STOP.value)
+        if (topic == "/commands_auto"):
+            # Un messaggio non valido viene accodato come gli altri e l'errore viene segnalato quando viene gestito
+            try:
+                return loads(decoded_msg).get("target") == str(Command.STOP.value)
+            except (ValueError, AttributeError):
+                return False
+        return False
+
+    def dispatch_loop(self):
+        while True:
+            with self._mailbox:
+                while not (self._urgent or self._ordered or self._latest):
+                    self._mailbox.wait()
+
+                if self._urgent:
+                    topic, decoded_msg = self._urgent.popleft()
+                elif self._ordered:
+                    topic, decoded_msg = self._ordered.popleft()
+                else:
+                    # Il primo topic di telemetria in attesa; quello gestito torna in fondo quando arriva un nuovo messaggio
+                    topic = next(iter(self._latest))
+                    decoded_msg = self._latest.pop(topic)
+
+            # Un messaggio non valido non deve fermare il thread, altrimenti le perceptions non verrebbero più gestite
+            try:
+                with self._controller._lock:
+                    self.handle_message(topic, decoded_msg)
+            except Exception as e:
+                print(f"Gestione del messaggio su {topic} fallita: {e!r}", flush=True)
+
+    def handle_message(self, topic, decoded_msg):
         # Se ricevo un messaggio sul topic mode vuol dire che ho cambiato modalità
         if (topic == "/mode"):
             self._controller.change_mode(decoded_msg)
@@ -494,8 +885,207 @@ class MqttManager:
         if (topic == "/tags"):
             self._controller.handle_tags(decoded_msg)
 
+        if (topic == "/sensors"):
+            self._controller.handle_sensors(decoded_msg)
+
+
+class InMemoryMqttClient:
+    # Sostituisce il client paho durante il benchmark: memorizza solo l'istante delle azioni pubblicate
+    def __init__(self):
+        # Lista di tuple (istante, azione)
+        self.actions = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if (topic == "/actions"):
+            self.actions.append((time.perf_counter(), payload))
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def loop_forever(self):
+        pass
+
+
+def check_avoidance_table():
+    ##
+    # Confronta la tabella con la logica originale su tutte le combinazioni di ingressi, controllando sia il comando
+    # restituito sia il comando di avoiding che resta impostato. Restituisce il numero di combinazioni diverse
+    ##
+    table = Controller.build_avoidance_table()
+    reference, compiled = Controller.__new__(Controller), Controller.__new__(Controller)
+    Controller._avoidance_table = table
+    checked = mismatches = 0
+    for last_command in AVOIDANCE_COMMANDS:
+        for last_avoiding_command in [""] + AVOIDANCE_COMMANDS[1:]:
+            for mode in Mode:
+                for mask in range(UNKNOWN_FREE_SPACES + 1):
+                    for probe in (reference, compiled):
+                        probe._last_command = last_command
+                        probe._last_avoiding_command = last_avoiding_command
+                        probe._mode = mode
+                        probe._free_spaces = Controller.free_spaces_from_mask(mask)
+                        probe._free_mask = Controller.mask_from_free_spaces(probe._free_spaces)
+
+                    expected = reference.avoid_obstacles_reference()
+                    result = compiled.avoid_obstacles()
+                    checked += 1
+                    if (expected != result or reference._last_avoiding_command != compiled._last_avoiding_command):
+                        mismatches += 1
+                        print(f"Diverso: {last_command.name}, {last_avoiding_command or '-'}, {mode.name}, "
+                              f"{mask:06b} -> {expected} invece di {result}", flush=True)
+
+    print(f"Combinazioni verificate: {checked}, diverse: {mismatches}", flush=True)
+    return mismatches
+
+
+def benchmark_avoidance(number=200):
+    ##
+    # Tempo medio per chiamata di avoid_obstacles con la tabella e con la logica originale, separando i casi in cui
+    # la direzione del comando è libera da quelli in cui va evitato un ostacolo. Gli ingressi sono preparati prima
+    # e il tempo per impostarli viene sottratto; di ogni misura tengo il minimo su più ripetizioni
+    ##
+    Controller._avoidance_table = Controller.build_avoidance_table()
+    probe = Controller.__new__(Controller)
+    random = Random(0)
+
+    cases = {"direzione libera": [], "ostacolo da evitare": []}
+    while (min(len(inputs) for inputs in cases.values()) < 512):
+        last_command = random.choice(AVOIDANCE_COMMANDS[1:])
+        mask = random.randrange(UNKNOWN_FREE_SPACES)
+        free_spaces = Controller.free_spaces_from_mask(mask)
+        inputs = cases["direzione libera" if free_spaces[last_command] else "ostacolo da evitare"]
+        inputs.append((last_command, random.choice([""] + AVOIDANCE_COMMANDS[1:]), random.choice(list(Mode)), free_spaces, mask))
+
+    def setup(inputs):
+        for last_command, last_avoiding_command, mode, free_spaces, mask in inputs:
+            probe._last_command = last_command
+            probe._last_avoiding_command = last_avoiding_command
+            probe._mode = mode
+            probe._free_spaces = free_spaces
+            probe._free_mask = mask
+
+    def run(inputs, method):
+        for last_command, last_avoiding_command, mode, free_spaces, mask in inputs:
+            probe._last_command = last_command
+            probe._last_avoiding_command = last_avoiding_command
+            probe._mode = mode
+            probe._free_spaces = free_spaces
+            probe._free_mask = mask
+            method(probe)
+
+    for case, inputs in cases.items():
+        inputs = inputs[:512]
+        baseline = min(repeat(lambda: setup(inputs), number=number, repeat=5))
+        for name, method in (("tabella", Controller.avoid_obstacles), ("originale", Controller.avoid_obstacles_reference)):
+            elapsed = min(repeat(lambda: run(inputs, method), number=number, repeat=5)) - baseline
+            print(f"avoid_obstacles, {case} ({name}): {elapsed / (number * len(inputs)) * 1e9:.0f} ns per chiamata",
+                  flush=True)
+
+
+def benchmark_dispatch(rates=(5000, 15000, 30000, 60000), duration=5):
+    ##
+    # Latenza tra l'arrivo di una perception con tutte le direzioni occupate e la pubblicazione dello STOP, durante
+    # un flusso di messaggi /tags (tre tag ciascuno) alla frequenza indicata. Un thread simula quello di rete di paho
+    # e consegna i messaggi nell'ordine di arrivo; una perception arriva ogni 100 ms, alternando direzioni tutte
+    # libere (il robot riparte in avanti) e tutte occupate. Ogni frequenza viene misurata sia gestendo i messaggi
+    # direttamente sul thread di rete, come prima del dispatcher, sia passando dalle code del dispatcher
+    ##
+    client = InMemoryMqttClient()
+    with redirect_stdout(StringIO()):
+        controller = Controller({'1': (0.5, 0.5)}, 1.5, 1.5, mqtt_client=client)
+    manager = controller._mqtt_manager
+    Constants.OCCUPANCY_SNAPSHOT_FILE = None
+
+    tags = dumps({"tags": [{"ID": i, "dist": 0.5 + 0.1 * i, "yaw": 10.0, "phi": 5.0} for i in range(3)]})
+    free = dumps({command.name: True for command in SENSOR_ANGLES})
+    blocked = dumps({command.name: False for command in SENSOR_ANGLES})
+
+    class Message:
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = payload.encode()
+
+    def inline(message):
+        with controller._lock:
+            manager.handle_message(message.topic, message.payload.decode())
+
+    network = deque()
+    arrived = Condition()
+
+    def network_loop(deliver, stop):
+        while True:
+            with arrived:
+                while not network and not stop.is_set():
+                    arrived.wait(0.1)
+                if (not network):
+                    return
+                message = network.popleft()
+            deliver(message)
+
+    with controller._lock:
+        controller.change_mode("AUTO")
+
+    for rate in rates:
+        for name, deliver in (("sul thread di rete", inline), ("dispatcher", lambda message: manager.on_message(None, None, message))):
+            stop = Event()
+            network_thread = Thread(target=network_loop, args=(deliver, stop), daemon=True)
+            obstacles = []
+            with redirect_stdout(StringIO()):
+                network_thread.start()
+                start = time.perf_counter()
+                next_tag, next_perception, blocked_next = start, start + 0.05, False
+                while (time.perf_counter() - start < duration):
+                    now = time.perf_counter()
+                    with arrived:
+                        while (now >= next_tag):
+                            network.append(Message("/tags", tags))
+                            next_tag += 1 / rate
+                        if (now >= next_perception):
+                            # Il robot sta andando avanti: con tutte le direzioni occupate l'avoidance restituisce STOP
+                            with controller._lock:
+                                controller._last_command = Command.FRONT
+                            network.append(Message("/perceptions", blocked if blocked_next else free))
+                            if blocked_next:
+                                obstacles.append(now)
+                            blocked_next = not blocked_next
+                            next_perception += 0.05
+                        arrived.notify()
+                    time.sleep(0.0002)
+
+                # Attendo che vengano gestiti i messaggi rimasti in coda
+                stop.set()
+                network_thread.join()
+                time.sleep(0.2)
+
+            stops = [t for t, action in client.actions if action == Command.STOP.value]
+            latencies = []
+            for obstacle in obstacles:
+                index = bisect_left(stops, obstacle)
+                if (index < len(stops)):
+                    latencies.append((stops[index] - obstacle) * 1e3)
+            client.actions.clear()
+            print(f"/tags a {rate}/s, {name}: STOP {len(latencies)}/{len(obstacles)}, "
+                  f"mediana {median(latencies):.1f} ms, massimo {max(latencies):.1f} ms", flush=True)
+
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--check-avoidance", action="store_true",
+                        help="verifica la tabella dell'obstacle avoidance con la logica originale ed esce")
+    parser.add_argument("--benchmark-avoidance", action="store_true",
+                        help="misura il tempo di avoid_obstacles con la tabella e con la logica originale ed esce")
+    parser.add_argument("--benchmark-dispatch", action="store_true",
+                        help="misura la latenza tra un ostacolo e lo STOP durante un flusso di /tags, con e senza dispatcher, ed esce")
+    args = parser.parse_args()
+
+    if (args.check_avoidance or args.benchmark_avoidance or args.benchmark_dispatch):
+        mismatches = check_avoidance_table() if args.check_avoidance else 0
+        if (args.benchmark_avoidance):
+            benchmark_avoidance()
+        if (args.benchmark_dispatch):
+            benchmark_dispatch()
+        raise SystemExit(1 if mismatches else 0)
+
     targets = {'1': (0.5, 0.5), '2': (
         0.5, -0.5), '3': (-0.5, -0.5), '4': (0, 0), '5': (-0.5, 0.5)}
     controller = Controller(targets, 1.5, 1.5)
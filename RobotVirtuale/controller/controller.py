@@ -3,7 +3,14 @@ from json import dumps, loads
 import paho.mqtt.client as mqtt
 from coppeliasim_zmqremoteapi_client import RemoteAPIClient
 from typing import Any
+from threading import Lock, Thread
+from argparse import ArgumentParser
+from random import Random
+from timeit import repeat
 import math
+import time
+from planner import GridPlanner
+from occupancy import OccupancyGrid
 
 
 class Mode(Enum):
@@ -20,6 +27,21 @@ class Command(Enum):
     STOP = -1
 
 
+# Direzione (in gradi, positiva a sinistra) rispetto all'orientamento del robot in cui guarda ogni sensore
+SENSOR_ANGLES = {
+    Command.LEFT: 90,
+    Command.FRONTLEFT: 45,
+    Command.FRONT: 0,
+    Command.FRONTRIGHT: -45,
+    Command.RIGHT: -90,
+}
+
+# Comandi su cui viene calcolata la tabella dell'obstacle avoidance, in posizione value + 1 (STOP, LEFT, ..., RIGHT)
+AVOIDANCE_COMMANDS = [Command.STOP, Command.LEFT, Command.FRONTLEFT, Command.FRONT, Command.FRONTRIGHT, Command.RIGHT]
+# Valore della maschera degli spazi liberi finché non arriva la prima perception (i bit 0-4 sono le direzioni libere)
+UNKNOWN_FREE_SPACES = 32
+
+
 class Constants:
     MY_SIM_HOST = "host.docker.internal"
     BROKER_HOSTNAME = "mqtt_virtuale"  # hostname del broker indicato nel docker-compose.yml
@@ -27,17 +49,41 @@ class Constants:
     PASSWORD = "contr_module"
     PORT = 1883
     CLOSE_ENOUGH_THRESHOLD = 0.05  # m
+    CONTROL_RATE = 10  # Hz, frequenza del ciclo di controllo che naviga verso il target in modalità automatica
+    POSE_RATE = 20  # Hz, frequenza con cui la posa del robot viene letta dal simulatore e pubblicata su /position
+    ARENA_WIDTH = 5  # m, dimensioni del pavimento della scena, centrato nell'origine
+    ARENA_HEIGHT = 5  # m
+    ROBOT_RADIUS = 0.25  # m, raggio del Pioneer P3DX
+    LONG_DISTANCE = 0.5  # IMPORTANTE: deve essere uguale alla long distance nel perception
+    GRID_RESOLUTION = 0.1  # m, lato delle celle della griglia usata per pianificare il percorso verso il target
+    # m, distanza dal centro del robot a cui viene segnato sulla griglia l'ostacolo che occupa una direzione
+    OBSTACLE_MAP_DISTANCE = ROBOT_RADIUS + LONG_DISTANCE / 2
+    SONAR_MAX_RANGE = 1.0  # m, portata dei sensori a ultrasuoni del Pioneer; oltre le letture indicano solo spazio libero
+    SONAR_CONE_ANGLE = 30  # gradi, ampiezza del cono dei sensori a ultrasuoni
+    # File .npy in cui viene salvata periodicamente la griglia di occupazione e da cui viene ripresa all'avvio (None per disattivare)
+    OCCUPANCY_SNAPSHOT_FILE = "occupancy.npy"
+    OCCUPANCY_SNAPSHOT_PERIOD = 5  # s
 
 
 class Controller:
 
-    def __init__(self):
+    # Tabella di decisione dell'obstacle avoidance, costruita all'avvio da build_avoidance_table
+    _avoidance_table = None
+
+    def __init__(self, arena_width: float = Constants.ARENA_WIDTH, arena_height: float = Constants.ARENA_HEIGHT):
         self._mode = Mode.MANUAL
         self._free_spaces = dict()
+        self._free_mask = UNKNOWN_FREE_SPACES
         self._last_action = ""
 
         # se diversa da "", allora significa che sto in una sessione di obstacle avoidance
         self._last_avoiding_command = ""
+
+        # La decisione dell'obstacle avoidance dipende solo da ultimo comando, comando di avoiding, modalità e spazi
+        # liberi, quindi viene calcolata una volta per tutte le combinazioni
+        if (Controller._avoidance_table is None):
+            Controller._avoidance_table = Controller.build_avoidance_table()
+
         self._mqtt_manager = MqttManager(self)
 
         # Invio della prima operazione all'avvio (stop)
@@ -54,12 +100,79 @@ class Controller:
         self._targets = dict()
         self.get_targets()
 
+        # Griglia di occupazione dell'arena su cui viene pianificato il percorso verso il target. Le celle vicine a un
+        # ostacolo meno del raggio del robot non sono attraversabili
+        self._planner = GridPlanner(arena_width, arena_height, Constants.GRID_RESOLUTION, Constants.ROBOT_RADIUS)
+
+        # Griglia di occupazione costruita con le distanze dei sonar, con la stessa risoluzione della griglia del
+        # planner. Le distanze sono misurate dal bordo del robot, quindi la portata dal centro è aumentata del raggio
+        self._occupancy = OccupancyGrid(arena_width, arena_height, Constants.GRID_RESOLUTION,
+                                        Constants.SONAR_MAX_RANGE + Constants.ROBOT_RADIUS, Constants.SONAR_CONE_ANGLE)
+        if (Constants.OCCUPANCY_SNAPSHOT_FILE is not None and self._occupancy.restore(Constants.OCCUPANCY_SNAPSHOT_FILE)):
+            print(f"Griglia di occupazione ripresa da {Constants.OCCUPANCY_SNAPSHOT_FILE}", flush=True)
+        self._last_snapshot = time.monotonic()
+        self.apply_occupancy()
+
+        # I target sono fissi: calcolo subito le distanze da ogni cella verso ognuno di essi e i percorsi tra i target
+        self._planner.precompute(list(self._targets.values()))
+
+        # Target ricevuto da gesture in modalità automatica (None se non ce n'è uno da raggiungere) e numero di
+        # sequenza dell'ultimo messaggio accettato, per scartare le copie ripetute consegnate con QoS 1
+        self._auto_target = None
+        self._auto_seq = -1
+
+        # Il ciclo di controllo, la lettura della posa e la gestione dei messaggi MQTT girano su thread diversi e
+        # condividono lo stato. Dopo l'avvio il client del simulatore viene usato solo dal thread della posa, quindi le
+        # chiamate al simulatore avvengono senza il lock e non rallentano la gestione dei messaggi
+        self._lock = Lock()
+
         # Invio della prima operazione all'avvio (stop)
         self._last_command = Command.STOP
         self.exec_command(Command.STOP)
 
+        Thread(target=self.pose_loop, daemon=True).start()
+        Thread(target=self.control_loop, daemon=True).start()
+
         self._mqtt_manager._client.loop_forever()
 
+    def control_loop(self):
+        # Esegue un passo di navigazione a frequenza fissa, indipendentemente dalla frequenza dei messaggi ricevuti
+        period = 1 / Constants.CONTROL_RATE
+        next_tick = time.monotonic()
+        while True:
+            # Un errore in un passo non deve fermare il ciclo, altrimenti il robot non verrebbe più controllato
+            try:
+                with self._lock:
+                    if (self._mode == Mode.AUTO and self._auto_target is not None):
+                        self.navigate_to_target()
+
+                    if (Constants.OCCUPANCY_SNAPSHOT_FILE is not None and
+                            time.monotonic() - self._last_snapshot >= Constants.OCCUPANCY_SNAPSHOT_PERIOD):
+                        self._occupancy.snapshot(Constants.OCCUPANCY_SNAPSHOT_FILE)
+                        self._last_snapshot = time.monotonic()
+            except Exception as e:
+                print(f"Passo del ciclo di controllo fallito: {e!r}", flush=True)
+
+            next_tick += period
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+    def pose_loop(self):
+        # Legge la posa dal simulatore a frequenza fissa e aggiorna quella usata dal controller
+        period = 1 / Constants.POSE_RATE
+        next_tick = time.monotonic()
+        while True:
+            # Se il simulatore non risponde mantengo l'ultima posa e riprovo al passo successivo
+            try:
+                my_pos, my_orientation = self.read_pose()
+                with self._lock:
+                    self._my_pos, self._my_orientation = my_pos, my_orientation
+                    self.publish_pose()
+            except Exception as e:
+                print(f"Lettura della posa fallita: {e!r}", flush=True)
+
+            next_tick += period
+            time.sleep(max(0, next_tick - time.monotonic()))
+
     def connect_to_sim(self):
         print("Connecting to simulator...", flush=True)
         client = RemoteAPIClient(host=Constants.MY_SIM_HOST)
@@ -67,14 +180,20 @@ class Controller:
         print('Connected', flush=True)
         self._robot_handler = self._sim.getObject("./PioneerP3DX")
 
-    def update_pos_and_orient(self):
+    def read_pose(self):
         robot_x, robot_y, _ = self._sim.getObjectPosition(self._robot_handler)
-        # Aggiorno la posizione attuale del robot
-        self._my_pos = (robot_x, robot_y)
 
         # Convertire gli angoli da radianti a gradi
-        _, _, self._my_orientation = tuple(
+        _, _, orientation = tuple(
             map(math.degrees, self._sim.getObjectOrientation(self._robot_handler, -1)))
+        return (robot_x, robot_y), orientation
+
+    def update_pos_and_orient(self):
+        # Aggiorno la posizione attuale del robot
+        self._my_pos, self._my_orientation = self.read_pose()
+        self.publish_pose()
+
+    def publish_pose(self):
         self._mqtt_manager._client.publish(
             "/position", dumps({"position": self._my_pos, "orientation": self._my_orientation}))
 
@@ -114,6 +233,50 @@ class Controller:
         return Command.STOP
 
     def avoid_obstacles(self):
+        # Il risultato e il nuovo comando di avoiding sono letti dalla tabella invece di rieseguire avoid_obstacles_reference.
+        # Uso _value_ invece di value perché value è una property dell'Enum e costa più dell'intera ricerca in tabella
+        command_index = self._last_command._value_ + 1
+        avoiding_index = 0 if self._last_avoiding_command == "" else self._last_avoiding_command._value_ + 1
+
+        command, self._last_avoiding_command = Controller._avoidance_table[
+            ((command_index * 6 + avoiding_index) * 2 + self._mode._value_ - 1) * 33 + self._free_mask]
+        return command
+
+    @staticmethod
+    def build_avoidance_table():
+        ##
+        # Esegue avoid_obstacles_reference per ogni combinazione di ultimo comando, comando di avoiding ("" o una
+        # delle cinque direzioni), modalità e maschera degli spazi liberi (32 combinazioni più "non inizializzati"),
+        # salvando il comando restituito e il comando di avoiding risultante. L'indice è quello usato in avoid_obstacles
+        ##
+        probe = Controller.__new__(Controller)
+        table = []
+        for last_command in AVOIDANCE_COMMANDS:
+            for last_avoiding_command in [""] + AVOIDANCE_COMMANDS[1:]:
+                for mode in Mode:
+                    for mask in range(UNKNOWN_FREE_SPACES + 1):
+                        probe._last_command = last_command
+                        probe._last_avoiding_command = last_avoiding_command
+                        probe._mode = mode
+                        probe._free_spaces = Controller.free_spaces_from_mask(mask)
+                        command = probe.avoid_obstacles_reference()
+                        table.append((command, probe._last_avoiding_command))
+        return table
+
+    @staticmethod
+    def free_spaces_from_mask(mask):
+        if (mask == UNKNOWN_FREE_SPACES):
+            return dict()
+        return {command: bool(mask >> command.value & 1) for command in AVOIDANCE_COMMANDS[1:]}
+
+    @staticmethod
+    def mask_from_free_spaces(free_spaces):
+        if (len(free_spaces) < len(AVOIDANCE_COMMANDS) - 1):
+            return UNKNOWN_FREE_SPACES
+        return sum(1 << command.value for command in AVOIDANCE_COMMANDS[1:] if free_spaces[command])
+
+    def avoid_obstacles_reference(self):
+        # Logica originale dell'obstacle avoidance, usata per costruire la tabella di decisione e per verificarla
 
         # L'obstacle avoidance non viene fatta se l'ultimo comando è STOP
         if (self._last_command == Command.STOP):
@@ -217,36 +380,74 @@ class Controller:
         self.exec_command(command)
 
     def handle_auto_cmnd(self, decoded_msg: str):
-        if (decoded_msg == str(Command.STOP.value)):
+        # Il messaggio contiene il numero di sequenza e il target (o STOP), ed è pubblicato solo quando cambia
+        decoded_json = loads(decoded_msg)
+        if (decoded_json["seq"] <= self._auto_seq):
+            return
+        self._auto_seq = decoded_json["seq"]
+
+        if (decoded_json["target"] == str(Command.STOP.value)):
+            self._auto_target = None
+            self._last_command = Command.STOP
+            self.exec_command(Command.STOP)
+
+        else:
+            # Memorizzo il nuovo obiettivo, che verrà raggiunto dal ciclo di controllo, e ripulisco la griglia dagli
+            # ostacoli visti dal perception durante il percorso precedente, tenendo quelli accumulati con i sonar
+            self._auto_target = decoded_json["target"]
+            self._planner.clear_obstacles()
+            self.apply_occupancy()
+
+    def navigate_to_target(self):
+        # Recupero dal dizionario la posizione da raggiungere
+        pos_to_reach = self._targets[self._auto_target]
+
+        # Se mi sono avvicinato abbastanza all'obiettivo, mi fermo
+        if (self.close_enough(pos_to_reach)):
+
             self._last_command = Command.STOP
             self.exec_command(Command.STOP)
+            self._auto_target = None
+            # Avviso il modulo gesture che sono arrivato
+            self._mqtt_manager._client.publish(
+                "/gesture_confirm", "reached", qos=1)
 
         else:
-            # Recupero dal dizionario la posizione da raggiungere
-            pos_to_reach = self._targets[decoded_msg]
 
-            # Se mi sono avvicinato abbastanza all'obiettivo, mi fermo
-            if (self.close_enough(pos_to_reach)):
+            # Imposta last command come la direzione migliore per raggiungere il prossimo punto del percorso
+            self.get_dir_to_target(
+                self.next_waypoint(pos_to_reach))
 
-                self._last_command = Command.STOP
-                self.exec_command(Command.STOP)
-                Command.FRONT
-                # Avviso il modulo gesture che sono arrivato
-                self._mqtt_manager._client.publish(
-                    "/gesture_confirm", "reached")
+            # Su tale direzione eseguo l'obstacle avoidance
+            command = self.avoid_obstacles()
 
-            else:
+            # Eseguo il comando così calcolato
+            self.exec_command(
+                command)
 
-                # Imposta last command come la direzione migliore per avvicinarsi al target
-                self.get_dir_to_target(
-                    pos_to_reach)
+    def next_waypoint(self, pos_to_reach):
+        # Seguo il campo di distanze del target (riparato dalla ricerca precedente) fino al primo punto più lontano del
+        # raggio del robot, così il robot non ruota sul posto verso punti che ha già raggiunto
+        waypoint = self._planner.next_point(self._my_pos, pos_to_reach, Constants.ROBOT_RADIUS)
 
-                # Su tale direzione eseguo l'obstacle avoidance
-                command = self.avoid_obstacles()
+        # Se sulla griglia il target non è raggiungibile mi dirigo direttamente verso di esso e lascio fare all'obstacle avoidance
+        if (waypoint is None):
+            return pos_to_reach
+        return waypoint
 
-                # Eseguo il comando così calcolato
-                self.exec_command(
-                    command)
+    def update_map(self):
+        ##
+        # Segno sulla griglia un ostacolo davanti a ogni direzione occupata. Le direzioni libere non cancellano gli
+        # ostacoli già segnati (il rumore dei sensori farebbe cambiare il percorso ad ogni messaggio): la griglia viene
+        # svuotata quando arriva un nuovo target
+        ##
+        my_x, my_y = self._my_pos
+        for command, free in self._free_spaces.items():
+            if free:
+                continue
+            angle = math.radians(self._my_orientation + SENSOR_ANGLES[command])
+            self._planner.set_obstacle((my_x + Constants.OBSTACLE_MAP_DISTANCE * math.cos(angle),
+                                        my_y + Constants.OBSTACLE_MAP_DISTANCE * math.sin(angle)), True)
 
     def handle_perceptions(self, decoded_msg: str):
         # Aggiorno i freespaces
@@ -256,6 +457,10 @@ class Controller:
         for key, value in decoded_json.items():
             enum_key = Command[key]
             self._free_spaces[enum_key] = value
+        self._free_mask = self.mask_from_free_spaces(self._free_spaces)
+
+        # Riporto gli ostacoli sulla griglia, così il prossimo passo di navigazione ripianifica il percorso
+        self.update_map()
 
         # Verifico se con le nuove perceptions c'è bisogno di evitare un ostacolo
         # command = Command.STOP
@@ -265,10 +470,31 @@ class Controller:
         # Eseguo l'operazione
         self.exec_command(command)
 
+    def handle_sensors(self, decoded_msg: str):
+        decoded_json = loads(decoded_msg)
+        distances = [decoded_json[command.name] + Constants.ROBOT_RADIUS for command in SENSOR_ANGLES]
+        cells, occupied = self._occupancy.update((*self._my_pos, self._my_orientation),
+                                                 list(SENSOR_ANGLES.values()), distances)
+
+        # Riporto sulla griglia del planner solo le celle che hanno cambiato stato
+        for point, is_occupied in zip(self._occupancy.to_points(cells), occupied):
+            self._planner.set_obstacle(point, bool(is_occupied))
+
+    def apply_occupancy(self):
+        for point in self._occupancy.to_points(self._occupancy.occupied_cells()):
+            self._planner.set_obstacle(point, True)
+
     def change_mode(self, decoded_msg: str):
         self._mode = Mode[decoded_msg]
         print("Cambio modalità in " + str(self._mode.name), flush=True)
 
+        # Il target automatico vale solo nella sessione in cui è stato scelto: al cambio di modalità lo scarto e fermo
+        # il robot, altrimenti tornando in automatico il ciclo di controllo ripartirebbe verso il vecchio target
+        self._auto_target = None
+        self._last_command = Command.STOP
+        self._last_avoiding_command = ""
+        self.exec_command(Command.STOP)
+
 
 class MqttManager:
 
@@ -286,16 +512,21 @@ class MqttManager:
     def on_connect(self, client, userdata, flags, rc):
         print("Connected with result code " + str(rc), flush=True)
         self._client.subscribe("/commands_manual")
-        self._client.subscribe("/commands_auto")
+        # I target automatici sono pubblicati una sola volta, quindi li ricevo con QoS 1
+        self._client.subscribe("/commands_auto", qos=1)
         self._client.subscribe("/perceptions")
+        self._client.subscribe("/sensors")
         self._client.subscribe("/mode")
 
     def on_message(self, client, rc, msg):
         topic = msg.topic
         decoded_msg = msg.payload.decode()
 
-        self._controller.update_pos_and_orient()
+        with self._controller._lock:
+            self.handle_message(topic, decoded_msg)
 
+    def handle_message(self, topic, decoded_msg):
+        # La posa è aggiornata dal thread della posa: qui viene solo aggiornato lo stato del controller
         if (decoded_msg == ""):
             return print("Messaggio vuoto")
 
@@ -312,6 +543,98 @@ class MqttManager:
         if (topic == "/perceptions"):
             self._controller.handle_perceptions(decoded_msg)
 
+        if (topic == "/sensors"):
+            self._controller.handle_sensors(decoded_msg)
+
+
+def check_avoidance_table():
+    ##
+    # Confronta la tabella con la logica originale su tutte le combinazioni di ingressi, controllando sia il comando
+    # restituito sia il comando di avoiding che resta impostato. Restituisce il numero di combinazioni diverse
+    ##
+    table = Controller.build_avoidance_table()
+    reference, compiled = Controller.__new__(Controller), Controller.__new__(Controller)
+    Controller._avoidance_table = table
+    checked = mismatches = 0
+    for last_command in AVOIDANCE_COMMANDS:
+        for last_avoiding_command in [""] + AVOIDANCE_COMMANDS[1:]:
+            for mode in Mode:
+                for mask in range(UNKNOWN_FREE_SPACES + 1):
+                    for probe in (reference, compiled):
+                        probe._last_command = last_command
+                        probe._last_avoiding_command = last_avoiding_command
+                        probe._mode = mode
+                        probe._free_spaces = Controller.free_spaces_from_mask(mask)
+                        probe._free_mask = Controller.mask_from_free_spaces(probe._free_spaces)
+
+                    expected = reference.avoid_obstacles_reference()
+                    result = compiled.avoid_obstacles()
+                    checked += 1
+                    if (expected != result or reference._last_avoiding_command != compiled._last_avoiding_command):
+                        mismatches += 1
+                        print(f"Diverso: {last_command.name}, {last_avoiding_command or '-'}, {mode.name}, "
+                              f"{mask:06b} -> {expected} invece di {result}", flush=True)
+
+    print(f"Combinazioni verificate: {checked}, diverse: {mismatches}", flush=True)
+    return mismatches
+
+
+def benchmark_avoidance(number=200):
+    ##
+    # Tempo medio per chiamata di avoid_obstacles con la tabella e con la logica originale, separando i casi in cui
+    # la direzione del comando è libera da quelli in cui va evitato un ostacolo. Gli ingressi sono preparati prima
+    # e il tempo per impostarli viene sottratto; di ogni misura tengo il minimo su più ripetizioni
+    ##
+    Controller._avoidance_table = Controller.build_avoidance_table()
+    probe = Controller.__new__(Controller)
+    random = Random(0)
+
+    cases = {"direzione libera": [], "ostacolo da evitare": []}
+    while (min(len(inputs) for inputs in cases.values()) < 512):
+        last_command = random.choice(AVOIDANCE_COMMANDS[1:])
+        mask = random.randrange(UNKNOWN_FREE_SPACES)
+        free_spaces = Controller.free_spaces_from_mask(mask)
+        inputs = cases["direzione libera" if free_spaces[last_command] else "ostacolo da evitare"]
+        inputs.append((last_command, random.choice([""] + AVOIDANCE_COMMANDS[1:]), random.choice(list(Mode)), free_spaces, mask))
+
+    def setup(inputs):
+        for last_command, last_avoiding_command, mode, free_spaces, mask in inputs:
+            probe._last_command = last_command
+            probe._last_avoiding_command = last_avoiding_command
+            probe._mode = mode
+            probe._free_spaces = free_spaces
+            probe._free_mask = mask
+
+    def run(inputs, method):
+        for last_command, last_avoiding_command, mode, free_spaces, mask in inputs:
+            probe._last_command = last_command
+            probe._last_avoiding_command = last_avoiding_command
+            probe._mode = mode
+            probe._free_spaces = free_spaces
+            probe._free_mask = mask
+            method(probe)
+
+    for case, inputs in cases.items():
+        inputs = inputs[:512]
+        baseline = min(repeat(lambda: setup(inputs), number=number, repeat=5))
+        for name, method in (("tabella", Controller.avoid_obstacles), ("originale", Controller.avoid_obstacles_reference)):
+            elapsed = min(repeat(lambda: run(inputs, method), number=number, repeat=5)) - baseline
+            print(f"avoid_obstacles, {case} ({name}): {elapsed / (number * len(inputs)) * 1e9:.0f} ns per chiamata",
+                  flush=True)
+
 
 if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--check-avoidance", action="store_true",
+                        help="verifica la tabella dell'obstacle avoidance con la logica originale ed esce")
+    parser.add_argument("--benchmark-avoidance", action="store_true",
+                        help="misura il tempo di avoid_obstacles con la tabella e con la logica originale ed esce")
+    args = parser.parse_args()
+
+    if (args.check_avoidance or args.benchmark_avoidance):
+        mismatches = check_avoidance_table() if args.check_avoidance else 0
+        if (args.benchmark_avoidance):
+            benchmark_avoidance()
+        raise SystemExit(1 if mismatches else 0)
+
     controller = Controller()
@@ -0,0 +1,109 @@
+import os
+import numpy as np
+
+
+class OccupancyGrid:
+    ##
+    # Griglia di occupazione dell'arena (centrata nell'origine) aggiornata con le distanze dei sonar.
+    # Ogni cella contiene il log-odds della probabilità di essere occupata: le letture lo aumentano nelle celle in
+    # cui c'è l'eco e lo diminuiscono in quelle attraversate dal cono prima dell'eco. La griglia ha dimensione fissa
+    # e i valori sono limitati, così una cella vista molte volte può comunque cambiare stato in tempi brevi
+    ##
+
+    L_OCCUPIED = 0.85  # incremento del log-odds per un'eco nella cella
+    L_FREE = -0.4  # incremento del log-odds per una cella attraversata dal cono
+    L_MIN = -4.0
+    L_MAX = 4.0
+    THRESHOLD = 0.5  # log-odds oltre cui la cella viene considerata occupata
+
+    RAYS_PER_CONE = 5  # raggi con cui viene campionato il cono di ogni sensore
+
+    def __init__(self, width: float, height: float, resolution: float, max_range: float, cone_angle: float):
+        self._resolution = resolution
+        self._origin = np.array([-width / 2, -height / 2])
+        self._nx = max(1, int(round(width / resolution)))
+        self._ny = max(1, int(round(height / resolution)))
+        self._max_range = max_range
+        self._log_odds = np.zeros(self._ny * self._nx, dtype=np.float32)
+
+        # Campioni (angolo rispetto all'asse del sensore, distanza) usati per ogni lettura, ogni mezza cella
+        self._ray_offsets = np.radians(np.linspace(-cone_angle / 2, cone_angle / 2, self.RAYS_PER_CONE))
+        self._radii = np.arange(resolution / 2, max_range + resolution / 2, resolution / 2)
+
+    @property
+    def shape(self):
+        return (self._ny, self._nx)
+
+    def update(self, pose, sensor_angles, distances):
+        ##
+        # Integra una lettura di tutti i sensori, con la posa (x, y, orientamento in gradi) del robot. Per ogni
+        # sensore le celle del cono più vicine dell'eco sono libere e quelle alla distanza dell'eco sono occupate.
+        # Le letture oltre max_range indicano solo spazio libero. Restituisce gli indici delle celle che hanno
+        # cambiato stato (libera/occupata) e il nuovo stato
+        ##
+        x, y, orientation = pose
+        distances = np.asarray(distances, dtype=np.float64)
+        angles = np.radians(orientation + np.asarray(sensor_angles, dtype=np.float64))
+
+        # Un campione per ogni sensore, raggio del cono e distanza: (sensori, raggi, distanze)
+        ray_angles = angles[:, None] + self._ray_offsets[None, :]
+        points_x = x + np.cos(ray_angles)[:, :, None] * self._radii
+        points_y = y + np.sin(ray_angles)[:, :, None] * self._radii
+
+        reading = distances[:, None, None]
+        free = self._radii < reading - self._resolution / 2
+        hit = (np.abs(self._radii - reading) <= self._resolution / 2) & (reading < self._max_range)
+
+        cells = self.to_cells(points_x, points_y)
+        inside = cells >= 0
+        hit_cells = np.unique(cells[hit & inside])
+        free_cells = np.setdiff1d(cells[free & inside], hit_cells)
+
+        touched = np.concatenate((hit_cells, free_cells))
+        was_occupied = self._log_odds[touched] > self.THRESHOLD
+
+        self._log_odds[hit_cells] += self.L_OCCUPIED
+        self._log_odds[free_cells] += self.L_FREE
+        self._log_odds[touched] = np.clip(self._log_odds[touched], self.L_MIN, self.L_MAX)
+
+        now_occupied = self._log_odds[touched] > self.THRESHOLD
+        changed = was_occupied != now_occupied
+        return touched[changed], now_occupied[changed]
+
+    def to_cells(self, points_x, points_y):
+        # Indice della cella di ogni punto, -1 per i punti fuori dalla griglia
+        ix = np.floor((points_x - self._origin[0]) / self._resolution).astype(np.int64)
+        iy = np.floor((points_y - self._origin[1]) / self._resolution).astype(np.int64)
+        inside = (ix >= 0) & (ix < self._nx) & (iy >= 0) & (iy < self._ny)
+        return np.where(inside, iy * self._nx + ix, -1)
+
+    def to_points(self, cells):
+        cells = np.asarray(cells)
+        return np.stack((self._origin[0] + (cells % self._nx + 0.5) * self._resolution,
+                         self._origin[1] + (cells // self._nx + 0.5) * self._resolution), axis=-1)
+
+    def occupied_cells(self):
+        return np.flatnonzero(self._log_odds > self.THRESHOLD)
+
+    def snapshot(self, path):
+        ##
+        # Salva la griglia in un file .npy mappabile in memoria, in modo che altri processi possano leggerlo con
+        # np.load(path, mmap_mode='r') senza copiarlo. Scrivo prima su un file temporaneo e poi lo sostituisco,
+        # così chi lo legge non vede mai una griglia scritta a metà
+        ##
+        temp_path = path + ".tmp"
+        snapshot = np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=self.shape)
+        snapshot[:] = self._log_odds.reshape(self.shape)
+        snapshot.flush()
+        del snapshot
+        os.replace(temp_path, path)
+
+    def restore(self, path):
+        # Carica una griglia salvata con snapshot, se esiste e ha le stesse dimensioni
+        if (not os.path.exists(path)):
+            return False
+        snapshot = np.load(path, mmap_mode='r')
+        if (snapshot.shape != self.shape):
+            return False
+        self._log_odds[:] = snapshot.reshape(-1)
+        return True
@@ -0,0 +1,366 @@
+from heapq import heapify, heappush, heappop
+from math import floor, hypot, inf
+
+
+class Search:
+    ##
+    # Stato della ricerca D* Lite verso un target: g e rhs sono la distanza di ogni cella dal target (un campo di
+    # distanze), la coda contiene le celle ancora da aggiornare. Le celle il cui costo è cambiato vengono raccolte
+    # in changed e riparate solo quando la ricerca viene usata, e solo finché serve per la cella di partenza.
+    # routes contiene i percorsi già estratti per cella di partenza, insieme alle celle attraversate dai loro tratti:
+    # un percorso resta valido finché le distanze non cambiano e nessun nuovo ostacolo copre una delle sue celle
+    ##
+
+    def __init__(self, goal: int, start: int):
+        self.goal = goal
+        self.start = start
+        self.g = {}
+        self.rhs = {goal: 0}
+        self.queue = []
+        self.queued = {}
+        self.km = 0
+        self.changed = set()
+        self.routes = {}
+
+
+class GridPlanner:
+    ##
+    # Pianificatore globale su una griglia di occupazione che copre l'arena (centrata nell'origine).
+    # Usa D* Lite: la ricerca parte dal target verso il robot, così quando il robot si sposta o vengono scoperti
+    # nuovi ostacoli vengono ricalcolate solo le celle i cui costi sono cambiati, riusando il resto della ricerca.
+    # Viene mantenuta una ricerca per ogni target, quindi tornare a un target già visitato non riparte da zero.
+    # Gli ostacoli sono punti: ogni cella a distanza minore di inflation_radius da un ostacolo non è attraversabile,
+    # così il robot può essere trattato come un punto
+    ##
+
+    def __init__(self, width: float, height: float, resolution: float, inflation_radius: float):
+        self._resolution = resolution
+        self._origin = (-width / 2, -height / 2)
+        self._nx = max(1, int(round(width / resolution)))
+        self._ny = max(1, int(round(height / resolution)))
+
+        # Le celle sono indicizzate con un intero (iy * nx + ix); per ognuna precalcolo i vicini (8-connessi) e il costo.
+        # I costi sono interi (10 in orizzontale/verticale, 14 in diagonale): con i float gli errori di arrotondamento
+        # rompono i pareggi tra le chiavi e la ricerca può terminare prima di aver trovato il percorso migliore
+        self._neighbours = [self._compute_neighbours(cell) for cell in range(self._nx * self._ny)]
+
+        # Numero di ostacoli che rendono la cella non attraversabile, ostacoli presenti e celle coperte da ciascuno
+        self._blocking = [0] * (self._nx * self._ny)
+        self._obstacles = set()
+        reach = int(inflation_radius / resolution)
+        self._inflation = [(dx, dy) for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)
+                           if hypot(dx, dy) * resolution < inflation_radius or (dx, dy) == (0, 0)]
+        # Spostamenti in cui cercare una cella libera, dal più vicino, se il robot si trova in una cella occupata
+        self._escape = sorted(((dx, dy) for dx in range(-reach - 1, reach + 2) for dy in range(-reach - 1, reach + 2)),
+                              key=lambda offset: hypot(*offset))
+
+        # Una ricerca (campo di distanze) per ogni cella target
+        self._searches = {}
+
+    def _compute_neighbours(self, cell):
+        ix, iy = cell % self._nx, cell // self._nx
+        neighbours = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                if (dx, dy) != (0, 0) and 0 <= ix + dx < self._nx and 0 <= iy + dy < self._ny:
+                    neighbours.append(((iy + dy) * self._nx + ix + dx, 14 if dx and dy else 10))
+        return neighbours
+
+    def to_cell(self, point):
+        ix = min(self._nx - 1, max(0, floor((point[0] - self._origin[0]) / self._resolution)))
+        iy = min(self._ny - 1, max(0, floor((point[1] - self._origin[1]) / self._resolution)))
+        return iy * self._nx + ix
+
+    def to_point(self, cell):
+        return (self._origin[0] + (cell % self._nx + 0.5) * self._resolution,
+                self._origin[1] + (cell // self._nx + 0.5) * self._resolution)
+
+    def is_free(self, cell):
+        return self._blocking[cell] == 0
+
+    def set_obstacle(self, point, occupied: bool):
+        # Aggiunge o rimuove l'ostacolo nella cella del punto; le ricerche vengono aggiornate quando vengono usate
+        cell = self.to_cell(point)
+        if ((cell in self._obstacles) == occupied):
+            return False
+
+        if occupied:
+            self._obstacles.add(cell)
+        else:
+            self._obstacles.discard(cell)
+        self._inflate(cell, 1 if occupied else -1)
+        return True
+
+    def clear_obstacles(self):
+        for cell in self._obstacles:
+            self._inflate(cell, -1)
+        self._obstacles.clear()
+
+    def _inflate(self, obstacle, delta):
+        ix, iy = obstacle % self._nx, obstacle // self._nx
+        covered = [(iy + dy) * self._nx + ix + dx for dx, dy in self._inflation
+                   if 0 <= ix + dx < self._nx and 0 <= iy + dy < self._ny]
+        for cell in covered:
+            self._blocking[cell] += delta
+
+        ##
+        # Invalido solo la zona coperta dall'ostacolo, e solo nelle ricerche che l'hanno già raggiunta: per le altre
+        # quelle celle hanno ancora distanza sconosciuta e verranno esplorate con il nuovo costo. Un arco cambia costo
+        # solo se una delle due celle o, in diagonale, una delle due celle d'angolo è coperta: in ogni caso le celle
+        # dell'arco sono vicine di una cella coperta, e ogni vicino di una cella con distanza nota ha già un rhs, quindi
+        # basta controllare le celle coperte. Dei percorsi estratti scarto solo quelli che attraversano la zona: i
+        # tratti in linea retta possono passare anche per celle mai esplorate, quindi non basta il campo di distanze
+        ##
+        covered = set(covered)
+        for search in self._searches.values():
+            if any(cell in search.rhs for cell in covered):
+                search.changed.update(covered)
+            for start_cell in [start_cell for start_cell, (_, cells) in search.routes.items() if not covered.isdisjoint(cells)]:
+                del search.routes[start_cell]
+
+    def precompute(self, goals):
+        ##
+        # Calcola all'avvio il campo di distanze completo verso ognuno dei target e i percorsi tra ogni coppia di
+        # target, così la prima navigazione verso un target non deve esplorare la griglia
+        ##
+        for goal in goals:
+            goal_cell = self.to_cell(goal)
+            self._compute_shortest_path(self._search_for(goal_cell, goal_cell), full=True)
+
+        for goal in goals:
+            for start in goals:
+                if (start != goal):
+                    self.plan(start, goal)
+
+    def plan(self, start, goal):
+        ##
+        # Restituisce la lista dei punti di passaggio (angoli del percorso, in metri) dalla posizione start fino al
+        # target goal, oppure None se il target non è raggiungibile. L'ultimo punto è sempre il target stesso
+        ##
+
+        prepared = self._prepare(start, goal)
+        if (prepared is None):
+            return None
+        search, start_cell, modified = prepared
+
+        # Se la ricerca non ha dovuto modificare il campo di distanze il percorso già estratto è ancora valido
+        route = search.routes.get(start_cell)
+        if (route is None or modified):
+            if (search.g.get(start_cell, inf) == inf):
+                return None
+            route = search.routes[start_cell] = self._extract_path(search, start_cell)
+
+        return route[0] + [goal]
+
+    def next_point(self, start, goal, lookahead: float):
+        ##
+        # Punto verso cui dirigersi per seguire il percorso ottimo da start a goal, oppure None se il target non è
+        # raggiungibile. Scendo lungo il campo di distanze del target, passando ogni volta al vicino con g minore,
+        # fino alla prima cella più lontana di lookahead da start: il costo non dipende dalla lunghezza del percorso,
+        # quindi può essere chiamato a ogni passo del ciclo di controllo
+        ##
+        prepared = self._prepare(start, goal)
+        if (prepared is None):
+            return None
+        search, cell, _ = prepared
+        if (search.g.get(cell, inf) == inf):
+            return None
+
+        for _ in range(int(2 * lookahead / self._resolution) + 2):
+            if (cell == search.goal):
+                return goal
+            cell = self._descend(search, cell)
+            point = self.to_point(cell)
+            if ((point[0] - start[0]) ** 2 + (point[1] - start[1]) ** 2 > lookahead ** 2):
+                return point
+        return point
+
+    def _prepare(self, start, goal):
+        ##
+        # Porta la ricerca verso goal alla posizione start, riparando le celle cambiate. Restituisce la ricerca, la
+        # cella di partenza e se il campo di distanze è stato modificato, oppure None se non c'è una cella libera
+        ##
+
+        # Se il robot è finito vicino a un ostacolo parto dalla cella libera più vicina: da una cella occupata il
+        # target risulterebbe irraggiungibile e la ricerca esplorerebbe inutilmente tutta la griglia
+        start_cell = self._nearest_free(self.to_cell(start))
+        if (start_cell is None):
+            return None
+
+        search = self._search_for(self.to_cell(goal), start_cell)
+
+        # Il robot si è spostato: le chiavi in coda diventano sottostimate di al più h(vecchio start, nuovo start)
+        if (start_cell != search.start):
+            search.km += self._heuristic(search.start, start_cell)
+            search.start = start_cell
+
+        # Aggiorno le celle adiacenti agli archi il cui costo è cambiato
+        if search.changed:
+            to_update = set(search.changed)
+            for cell in search.changed:
+                to_update.update(neighbour for neighbour, _ in self._neighbours[cell])
+            search.changed.clear()
+            for cell in to_update:
+                self._update_vertex(search, cell)
+
+        # Se il campo di distanze cambia i percorsi estratti restano liberi ma possono non essere più i più brevi
+        modified = self._compute_shortest_path(search)
+        if modified:
+            search.routes.clear()
+        return search, start_cell, modified
+
+    def _search_for(self, goal_cell, start_cell):
+        search = self._searches.get(goal_cell)
+        if (search is None):
+            search = self._searches[goal_cell] = Search(goal_cell, start_cell)
+            self._push(search, goal_cell)
+        return search
+
+    def _nearest_free(self, cell):
+        ix, iy = cell % self._nx, cell // self._nx
+        for dx, dy in self._escape:
+            if 0 <= ix + dx < self._nx and 0 <= iy + dy < self._ny and self._blocking[(iy + dy) * self._nx + ix + dx] == 0:
+                return (iy + dy) * self._nx + ix + dx
+        return None
+
+    def _heuristic(self, a, b):
+        # Distanza ottimale su una griglia 8-connessa senza ostacoli (octile)
+        dx = abs(a % self._nx - b % self._nx)
+        dy = abs(a // self._nx - b // self._nx)
+        return 10 * max(dx, dy) + 4 * min(dx, dy)
+
+    def _cost(self, a, b, step):
+        blocking = self._blocking
+        if (blocking[a] != 0 or blocking[b] != 0):
+            return inf
+        # In diagonale il robot passa per il vertice comune: anche le due celle che lo toccano devono essere libere,
+        # altrimenti il percorso taglierebbe l'angolo tra due celle occupate
+        if (step == 14 and (blocking[a - a % self._nx + b % self._nx] != 0 or blocking[b - b % self._nx + a % self._nx] != 0)):
+            return inf
+        return step
+
+    def _key(self, search, cell):
+        best = min(search.g.get(cell, inf), search.rhs.get(cell, inf))
+        return (best + self._heuristic(search.start, cell) + search.km, best)
+
+    def _push(self, search, cell):
+        key = self._key(search, cell)
+        search.queued[cell] = key
+        heappush(search.queue, (key, cell))
+
+    def _update_vertex(self, search, cell):
+        if (cell != search.goal):
+            g = search.g
+            search.rhs[cell] = min((self._cost(cell, neighbour, step) + g.get(neighbour, inf)
+                                    for neighbour, step in self._neighbours[cell]), default=inf)
+        # La cella viene rimossa dalla coda in modo pigro: le voci con chiave diversa da queued vengono ignorate
+        search.queued.pop(cell, None)
+        if (search.g.get(cell, inf) != search.rhs.get(cell, inf)):
+            self._push(search, cell)
+
+    def _compute_shortest_path(self, search, full=False):
+        ##
+        # Espande le celle finché la distanza della cella di partenza è corretta (con full finché la coda non è
+        # vuota, calcolando il campo di distanze su tutta la griglia). Restituisce True se ha modificato il campo
+        ##
+        queue, queued, g, rhs = search.queue, search.queued, search.g, search.rhs
+        start = search.start
+        modified = False
+        while queue:
+            key, cell = queue[0]
+            if (queued.get(cell) != key):
+                heappop(queue)
+                continue
+            if (not full and key >= self._key(search, start) and rhs.get(start, inf) == g.get(start, inf)):
+                break
+
+            heappop(queue)
+            del queued[cell]
+            new_key = self._key(search, cell)
+            if (key < new_key):
+                self._push(search, cell)
+                continue
+
+            modified = True
+            if (g.get(cell, inf) > rhs.get(cell, inf)):
+                g[cell] = rhs[cell]
+                for neighbour, _ in self._neighbours[cell]:
+                    self._update_vertex(search, neighbour)
+            else:
+                g[cell] = inf
+                self._update_vertex(search, cell)
+                for neighbour, _ in self._neighbours[cell]:
+                    self._update_vertex(search, neighbour)
+
+        # Le voci non più valide restano nella coda finché non arrivano in cima: se sono troppe la ricostruisco
+        if (len(search.queue) > 2 * len(queued) + 64):
+            search.queue = [(key, cell) for cell, key in queued.items()]
+            heapify(search.queue)
+
+        return modified
+
+    def _descend(self, search, cell):
+        # Vicino attraverso cui passa il percorso più breve dalla cella al target
+        return min(self._neighbours[cell], key=lambda item: self._cost(cell, item[0], item[1]) + search.g.get(item[0], inf))[0]
+
+    def _extract_path(self, search, start_cell):
+        ##
+        # Scendo lungo g fino al target, poi tengo solo i punti necessari perché ogni tratto sia in linea retta su celle
+        # libere. Restituisce i punti di passaggio e l'insieme delle celle attraversate dai tratti
+        ##
+        cells = [start_cell]
+        while (cells[-1] != search.goal and len(cells) <= len(self._neighbours)):
+            cells.append(self._descend(search, cells[-1]))
+
+        # Ogni punto emesso chiude un tratto già verificato con _line_of_sight: previous è stato controllato come cell
+        # al passo precedente, e il primo passo collega due celle adiacenti che _cost garantisce libere anche agli angoli
+        waypoints = []
+        anchor = start_cell
+        corners = [start_cell]
+        for previous, cell in zip(cells, cells[1:]):
+            if (not self._line_of_sight(anchor, cell)):
+                waypoints.append(self.to_point(previous))
+                corners.append(previous)
+                anchor = previous
+        corners.append(cells[-1])
+
+        crossed = set()
+        for a, b in zip(corners, corners[1:]):
+            crossed.update(self._supercover(a, b))
+        return waypoints, crossed
+
+    def _line_of_sight(self, a, b):
+        blocking = self._blocking
+        return all(blocking[cell] == 0 for cell in self._supercover(a, b))
+
+    def _supercover(self, a, b):
+        ##
+        # Tutte le celle attraversate dal segmento tra i centri delle due celle (supercover): a ogni passo confronto in
+        # interi quale bordo di cella il segmento incontra prima. Se passa esattamente per un vertice restituisco
+        # entrambe le celle che lo toccano, così come fa _cost per i passi in diagonale il segmento non taglia l'angolo
+        ##
+        nx = self._nx
+        x, y = a % nx, a // nx
+        bx, by = b % nx, b // nx
+        dx, dy = abs(bx - x), abs(by - y)
+        sx, sy = (1 if bx > x else -1), (1 if by > y else -1)
+        error = dx - dy
+        remaining = dx + dy
+        yield a
+        while (remaining > 0):
+            if (error > 0):
+                x += sx
+                error -= 2 * dy
+                remaining -= 1
+            elif (error < 0):
+                y += sy
+                error += 2 * dx
+                remaining -= 1
+            else:
+                yield y * nx + x + sx
+                yield (y + sy) * nx + x
+                x += sx
+                y += sy
+                error += 2 * (dx - dy)
+                remaining -= 2
+            yield y * nx + x
@@ -1,11 +1,19 @@
 import paho.mqtt.client as mqtt
 import cv2
 import mediapipe as mp
+import numpy as np
 import time
 import math
+import threading
+import argparse
+import signal
+from abc import ABC, abstractmethod
+from bisect import bisect
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from enum import Enum
 from coppeliasim_zmqremoteapi_client import RemoteAPIClient
-from json import loads
+from json import loads, dumps, dump
 
 class Command(Enum):
     LEFT = 0
@@ -24,10 +32,77 @@ class Constants:
     MEAN_DIMENSION = 20
     # Somma di tutti gli elementi usati per la media pesata
     MEAN_DENOM = sum(range(1, MEAN_DIMENSION + 1))
-    # Rate di refresh della camera
-    CAM_REFRESH_TIME = 0.05
+    # Margine minimo (rispetto a MEAN_DENOM) tra il numero più votato e il secondo per fissare il target prima di riempire la finestra
+    VOTE_CONFIDENCE = 0.4
+    # Numero minimo di frame votati prima di poter fissare il target
+    MIN_VOTE_FRAMES = 5
+    # Numero di frame consecutivi con la mano chiusa o assente tollerati durante il calcolo senza azzerarlo
+    MAX_MISSED_FRAMES = 3
+    # Numero di frame su cui viene fatta la votazione a maggioranza della direzione in modalità manuale (1 per disattivarla)
+    DIRECTION_WINDOW = 5
+    # Margine (in gradi) oltre il confine di una direzione che l'indice deve superare per passare alla direzione vicina
+    DIRECTION_HYSTERESIS = 8
+    # Frequenza obiettivo (frame al secondo) con cui vengono acquisite le immagini dalla camera
+    TARGET_FPS = 30
+    # Risoluzione richiesta alla camera: la più piccola che non perde dettaglio rispetto all'inferenza e alla finestra
+    CAPTURE_WIDTH = 640
+    CAPTURE_HEIGHT = 480
+    # Codec richiesto alla camera: con MJPG la maggior parte delle webcam USB raggiunge i 30 FPS anche a risoluzioni più alte
+    CAPTURE_FOURCC = "MJPG"
+    # Numero di frame nel buffer interno della camera: con un solo frame viene letto sempre quello più recente
+    CAPTURE_BUFFER_SIZE = 1
     # Dimensioni della finestra con la webcam
     WINDOW_WIDTH = 500
+    # Larghezza dell'immagine passata a Mediapipe, ridimensionata prima dell'inferenza (0 per usare la risoluzione della camera)
+    INFERENCE_WIDTH = 320
+    # Margine aggiunto attorno al riquadro della mano del frame precedente, in proporzione al lato del riquadro
+    ROI_MARGIN = 0.3
+    # Dimensione (larghezza, altezza) del frame ridotto usato per rilevare il movimento
+    GATE_SIZE = (64, 48)
+    # Differenza di grigio oltre la quale un pixel del frame ridotto è considerato cambiato
+    GATE_PIXEL_THRESHOLD = 15
+    # Percentuale di pixel cambiati oltre la quale la scena è considerata in movimento
+    GATE_CHANGED_RATIO = 0.01
+    # Numero massimo di frame consecutivi in cui Mediapipe può essere saltato
+    GATE_MAX_SKIPPED_FRAMES = 10
+    # Fattori di scala della risoluzione di inferenza usati dal controllo adattivo dopo aver ridotto la complessità del modello
+    ADAPTIVE_WIDTH_SCALES = [0.75, 0.5]
+    # Larghezza di partenza del controllo adattivo quando l'inferenza avviene alla risoluzione della camera
+    ADAPTIVE_BASE_WIDTH = 640
+    # Peso dell'ultima misura nella media mobile esponenziale della latenza di inferenza
+    ADAPTIVE_EMA_ALPHA = 0.1
+    # Numero minimo di inferenze tra due cambi di livello
+    ADAPTIVE_MIN_FRAMES = 30
+    # Si torna al livello superiore solo se la latenza è sotto questa frazione del tempo disponibile per frame
+    ADAPTIVE_HEADROOM = 0.5
+    # Attesa massima (in inferenze) prima di ritentare un livello superiore che si era rivelato troppo lento
+    ADAPTIVE_MAX_UP_WAIT = 1800
+    # Attesa iniziale e massima (in secondi) tra due tentativi di connessione al broker: l'attesa raddoppia a ogni tentativo fallito
+    MQTT_RETRY_MIN_DELAY = 0.5
+    MQTT_RETRY_MAX_DELAY = 5
+    # Ogni quanti secondi viene stampato il numero di frame al secondo raggiunto
+    FPS_REPORT_INTERVAL = 5
+    # Frequenza massima, larghezza e qualità JPEG dei frame inviati dall'anteprima di rete
+    PREVIEW_FPS = 15
+    PREVIEW_WIDTH = 320
+    PREVIEW_JPEG_QUALITY = 70
+    # Qualità JPEG dei frame salvati durante la registrazione di una sessione
+    RECORD_JPEG_QUALITY = 80
+    # Indici dei landmark di polso, punte e nocche (indice, medio, anulare, mignolo) usati per contare le dita
+    WRIST = 0
+    THUMB_TIP = 4
+    FINGER_TIPS = [8, 12, 16, 20]
+    FINGER_KNUCKLES = [6, 10, 14, 18]
+    PINKY_BASE = 17
+    FEATURE_LANDMARKS = np.array(FINGER_TIPS + FINGER_KNUCKLES + [PINKY_BASE])
+    # Margine oltre il quale il pollice è considerato aperto
+    THUMB_MARGIN = 1.1
+    # Landmark (nocca del medio) che definisce asse e scala della mano per le feature del classificatore appreso
+    MIDDLE_BASE = 9
+    # Regolarizzazione della regressione ridge usata per addestrare il classificatore appreso
+    CLASSIFIER_REGULARIZATION = 1e-2
+    # Un campione ogni quanti viene tenuto da parte per la validazione durante l'addestramento
+    CLASSIFIER_VALIDATION_STEP = 5
 
 class MathUtils:
 
@@ -45,139 +120,840 @@ class MathUtils:
 
         return math.sqrt((point_2[0] - point_1[0])**2 + (point_2[1] - point_1[1])**2)
 
+class TargetVote:
+    ##
+    # Voto pesato sugli ultimi `size` conteggi delle dita, memorizzati in un buffer circolare. Come nella vecchia
+    # media pesata il voto più recente pesa `size` e il più vecchio 1, ma l'aggiornamento costa O(1): a ogni nuovo
+    # voto tutti i pesi calano di 1, quindi al punteggio di ogni numero basta sottrarre quanti voti ha nella finestra
+    ##
+    def __init__(self, size=Constants.MEAN_DIMENSION, values=6):
+        self._size = size
+        self._values = values
+        self._buffer = [0] * size
+        # Punteggio massimo di un numero con la finestra piena (size + ... + 1)
+        self._denominator = size * (size + 1) // 2
+        self.reset()
+
+    def reset(self):
+        self._index = 0
+        self.frames = 0
+        self._counts = [0] * self._values
+        self._scores = [0] * self._values
+
+    def add(self, value):
+        for i in range(self._values):
+            self._scores[i] -= self._counts[i]
+
+        # Il voto più vecchio, arrivato a peso 0, esce dalla finestra
+        if self.frames >= self._size:
+            self._counts[self._buffer[self._index]] -= 1
+
+        self._buffer[self._index] = value
+        self._counts[value] += 1
+        self._scores[value] += self._size
+
+        self._index = (self._index + 1) % self._size
+        self.frames += 1
+
+    def winner(self):
+        return max(range(self._values), key=self._scores.__getitem__)
+
+    def margin(self):
+        # Distacco tra il numero più votato e il secondo, normalizzato sul punteggio massimo della finestra piena
+        best, second = sorted(self._scores, reverse=True)[:2]
+        return (best - second) / self._denominator
+
+    def is_full(self):
+        return self.frames >= self._size
+
+class DirectionFilter:
+    ##
+    # Filtra la direzione indicata dall'indice in modalità manuale, in modo che un dito vicino al confine tra due
+    # direzioni non faccia pubblicare un comando a ogni frame. L'angolo dell'indice rispetto al polso viene prima
+    # assegnato a un intervallo con isteresi (si cambia intervallo solo superando il confine di almeno
+    # hysteresis gradi), poi la direzione pubblicata cambia solo quando un intervallo ottiene la maggioranza
+    # degli ultimi window frame. STOP non passa dal filtro: basta chiamare reset
+    ##
+
+    # Confini (in gradi) tra le direzioni, corrispondenti ai coefficienti angolari 1 e 3
+    BOUNDARIES = [45, math.degrees(math.atan(3)), 180 - math.degrees(math.atan(3)), 135]
+    COMMANDS = [Command.RIGHT, Command.FRONTRIGHT, Command.FRONT, Command.FRONTLEFT, Command.LEFT]
+
+    def __init__(self, window=Constants.DIRECTION_WINDOW, hysteresis=Constants.DIRECTION_HYSTERESIS):
+        self._hysteresis = hysteresis
+        self._votes = deque(maxlen=max(1, window))
+        self._majority = self._votes.maxlen // 2 + 1
+        self._counts = [0] * len(DirectionFilter.COMMANDS)
+        self._bin = None
+        self._output = None
+
+    @staticmethod
+    def get_command(angle):
+        # Direzione senza filtro: 0 gradi è a destra, 90 in avanti, 180 a sinistra
+        return DirectionFilter.COMMANDS[bisect(DirectionFilter.BOUNDARIES, angle)]
+
+    def reset(self):
+        self._votes.clear()
+        self._counts = [0] * len(DirectionFilter.COMMANDS)
+        self._bin = None
+        self._output = None
+
+    def update(self, angle):
+        new_bin = bisect(DirectionFilter.BOUNDARIES, angle)
+
+        # Resto nell'intervallo precedente finché l'angolo non supera il suo confine di almeno hysteresis gradi
+        if self._bin is not None and new_bin != self._bin:
+            low = DirectionFilter.BOUNDARIES[self._bin - 1] if self._bin > 0 else -math.inf
+            high = DirectionFilter.BOUNDARIES[self._bin] if self._bin < len(DirectionFilter.BOUNDARIES) else math.inf
+            if low - self._hysteresis <= angle <= high + self._hysteresis:
+                new_bin = self._bin
+        self._bin = new_bin
+
+        if len(self._votes) == self._votes.maxlen:
+            self._counts[self._votes[0]] -= 1
+        self._votes.append(new_bin)
+        self._counts[new_bin] += 1
+
+        # Finché nessuna direzione ha la maggioranza mantengo quella precedente (o STOP dopo un reset)
+        if self._counts[new_bin] >= self._majority:
+            self._output = new_bin
+
+        return Command.STOP if self._output is None else DirectionFilter.COMMANDS[self._output]
+
+class RateLimiter:
+    # Sostituisce la sleep fissa: attende solo il tempo che manca per rispettare la frequenza obiettivo
+    def __init__(self, target_fps):
+        self._period = 1 / target_fps if target_fps > 0 else 0
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if self._next_time > now:
+            time.sleep(self._next_time - now)
+            now = self._next_time
+        # Se sono in ritardo non provo a recuperare i frame persi, riparto da adesso
+        self._next_time = max(self._next_time + self._period, now)
+
+class FpsMeter:
+    # Conta i frame elaborati e stampa periodicamente i frame al secondo raggiunti
+    def __init__(self, label, report_interval=Constants.FPS_REPORT_INTERVAL):
+        self._label = label
+        self._report_interval = report_interval
+        self._start = time.monotonic()
+        self._frames = 0
+        self.fps = 0
+
+    def tick(self):
+        self._frames += 1
+        elapsed = time.monotonic() - self._start
+        if elapsed >= self._report_interval:
+            self.fps = self._frames / elapsed
+            print(f"[{self._label}] {self.fps:.1f} FPS", flush=True)
+            self._start = time.monotonic()
+            self._frames = 0
+
+class LatestQueue:
+    ##
+    # Coda limitata tra due stadi della pipeline: se è piena, l'elemento più vecchio viene scartato
+    # in modo che il consumatore lavori sempre sul frame più recente
+    ##
+    def __init__(self, maxsize=1, on_drop=None):
+        self._items = deque(maxlen=maxsize)
+        self._condition = threading.Condition()
+        # Chiamata con l'elemento scartato, ad esempio per restituire il suo buffer al pool
+        self._on_drop = on_drop
+        self.dropped = 0
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+                if self._on_drop is not None:
+                    self._on_drop(self._items[0])
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout=None):
+        # Restituisce None se entro il timeout non arriva nessun elemento
+        with self._condition:
+            if not self._condition.wait_for(lambda: len(self._items) > 0, timeout):
+                return None
+            return self._items.popleft()
+
+class FramePool:
+    ##
+    # Buffer per le immagini riutilizzati tra un frame e l'altro: acquire restituisce un buffer libero della forma
+    # richiesta e ne alloca uno nuovo solo se non ce ne sono, release lo rimette a disposizione. Le immagini passano
+    # tra gli stadi della pipeline per riferimento e tornano nel pool quando nessuno stadio le usa più, quindi a regime
+    # ci sono solo tanti buffer quanti sono i frame in volo
+    ##
+    def __init__(self):
+        self._free = []
+        self._lock = threading.Lock()
+        self.allocated = 0
+
+    def acquire(self, shape):
+        with self._lock:
+            while self._free:
+                buffer = self._free.pop()
+                # I buffer di una forma diversa (ad esempio dopo un cambio di risoluzione) vengono lasciati al garbage collector
+                if buffer.shape == shape:
+                    return buffer
+            self.allocated += 1
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, buffer):
+        if buffer is None:
+            return
+        with self._lock:
+            self._free.append(buffer)
+
+class ScratchBuffers:
+    ##
+    # Buffer temporanei usati all'interno di un solo stadio, indicizzati per nome. Le dimensioni del ritaglio della mano
+    # cambiano a ogni frame, quindi ogni buffer è un array piatto che viene riallocato solo quando deve crescere
+    # e di cui viene restituita una vista contigua della forma richiesta
+    ##
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape):
+        size = math.prod(shape)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty(size, dtype=np.uint8)
+            self._buffers[name] = buffer
+        return buffer[:size].reshape(shape)
+
+class FrameReader:
+    ##
+    # Legge i frame dalla camera direttamente in un buffer preso dal pool, che chi usa il frame deve restituire
+    # con release. Il riflesso a specchio viene fatto sul posto; per DroidCAM la rotazione seguita dal riflesso
+    # equivale a una trasposizione, che non si può fare sul posto e quindi usa un secondo buffer riutilizzato
+    ##
+    def __init__(self, device: cv2.VideoCapture, is_from_phone: bool, pool=None):
+        self._device = device
+        self._is_from_phone = is_from_phone
+        self.pool = pool if pool is not None else FramePool()
+        self._raw = None
+        self._shape = None
+
+    def read(self):
+        # Se la risoluzione cambia OpenCV alloca un nuovo array, che da quel momento viene riutilizzato al posto del buffer
+        if self._is_from_phone:
+            success, raw = self._device.read(self._raw)
+            if not success:
+                return None
+            self._raw = raw
+
+            height, width, channels = raw.shape
+            image = self.pool.acquire((width, height, channels))
+            cv2.transpose(raw, dst=image)
+            return image
+
+        buffer = self.pool.acquire(self._shape) if self._shape is not None else None
+        success, image = self._device.read(buffer)
+        if not success:
+            self.pool.release(buffer)
+            return None
+        self._shape = image.shape
+
+        # Riflette l'immagine a specchio
+        cv2.flip(image, 1, dst=image)  # 1 indica il riflesso orizzontale
+        return image
+
+    def release(self, image):
+        self.pool.release(image)
+
+class MotionGate:
+    ##
+    # Pre-stadio economico che decide se serve eseguire Mediapipe: confronta una versione ridotta in scala di grigi
+    # del frame con quella dell'ultimo frame su cui è stata fatta l'inferenza. Se la scena non è cambiata viene
+    # riutilizzato l'ultimo risultato, ma l'inferenza viene comunque ripetuta almeno ogni max_skipped_frames frame.
+    # Quando una mano entra nell'inquadratura il frame è già diverso, quindi non si aggiunge latenza
+    ##
+    def __init__(self, size=Constants.GATE_SIZE, pixel_threshold=Constants.GATE_PIXEL_THRESHOLD,
+                 changed_ratio=Constants.GATE_CHANGED_RATIO, max_skipped_frames=Constants.GATE_MAX_SKIPPED_FRAMES):
+        self._size = size
+        self._pixel_threshold = pixel_threshold
+        self._min_changed_pixels = max(1, int(changed_ratio * size[0] * size[1]))
+        self._max_skipped_frames = max_skipped_frames
+
+        width, height = size
+        self._small = np.empty((height, width, 3), dtype=np.uint8)
+        self._gray = np.empty((height, width), dtype=np.uint8)
+        self._reference = np.empty((height, width), dtype=np.uint8)
+        self._diff = np.empty((height, width), dtype=np.uint8)
+        self._has_reference = False
+
+        self._skipped_frames = 0
+        self.inferred = 0
+        self.skipped = 0
+
+    def needs_inference(self, image):
+        cv2.resize(image, self._size, dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+        if self._has_reference and self._skipped_frames < self._max_skipped_frames:
+            cv2.absdiff(self._gray, self._reference, dst=self._diff)
+            if np.count_nonzero(self._diff > self._pixel_threshold) < self._min_changed_pixels:
+                self._skipped_frames += 1
+                self.skipped += 1
+                return False
+
+        # Il frame corrente diventa il riferimento per i successivi
+        self._gray, self._reference = self._reference, self._gray
+        self._has_reference = True
+        self._skipped_frames = 0
+        self.inferred += 1
+        return True
+
+class ComplexityController:
+    ##
+    # Misura la latenza dell'inferenza e, se i frame al secondo raggiungibili scendono sotto l'obiettivo, passa al livello
+    # successivo (prima un modello Mediapipe meno complesso, poi una risoluzione di inferenza più bassa). Quando c'è
+    # margine torna al livello precedente; se un livello superiore si rivela di nuovo troppo lento, l'attesa prima di
+    # ritentarlo raddoppia, così il controllo non oscilla. Ogni decisione viene stampata per poterlo tarare su ogni macchina
+    ##
+    def __init__(self, target_fps, model_complexity, inference_width):
+        self._budget = 1 / target_fps
+        base_width = inference_width or Constants.ADAPTIVE_BASE_WIDTH
+        # Ogni livello è una coppia (complessità del modello, larghezza di inferenza), dal più preciso al più veloce
+        self.levels = [(model_complexity, inference_width)]
+        if model_complexity > 0:
+            self.levels.append((0, inference_width))
+        self.levels += [(0, int(base_width * scale)) for scale in Constants.ADAPTIVE_WIDTH_SCALES]
+        self.level = 0
+
+        self._latency = None
+        self._frames_since_switch = 0
+        self._up_wait = Constants.ADAPTIVE_MIN_FRAMES * 2
+        self._last_switch_was_up = False
+
+        self._window_start = time.monotonic()
+        self._window_frames = 0
+        self._inference_fps = 0
+
+    def update(self, latency):
+        # Restituisce il nuovo livello (complessità, larghezza) se va cambiato, altrimenti None
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += Constants.ADAPTIVE_EMA_ALPHA * (latency - self._latency)
+        self._frames_since_switch += 1
+
+        self._window_frames += 1
+        elapsed = time.monotonic() - self._window_start
+        if elapsed >= 1:
+            self._inference_fps = self._window_frames / elapsed
+            self._window_start = time.monotonic()
+            self._window_frames = 0
+
+        if self._frames_since_switch < Constants.ADAPTIVE_MIN_FRAMES:
+            return None
+
+        if self._latency > self._budget and self.level < len(self.levels) - 1:
+            # Se appena salito di livello devo già scendere, la prossima volta aspetto il doppio prima di risalire
+            if self._last_switch_was_up:
+                self._up_wait = min(self._up_wait * 2, Constants.ADAPTIVE_MAX_UP_WAIT)
+            return self.switch(self.level + 1, "giù")
+
+        if self._latency < self._budget * Constants.ADAPTIVE_HEADROOM and self.level > 0 and self._frames_since_switch >= self._up_wait:
+            return self.switch(self.level - 1, "su")
+
+        # Se il livello raggiunto salendo regge per un po', l'attesa torna quella iniziale
+        if self._last_switch_was_up and self._frames_since_switch >= self._up_wait:
+            self._last_switch_was_up = False
+            self._up_wait = Constants.ADAPTIVE_MIN_FRAMES * 2
+
+        return None
+
+    def switch(self, level, direction):
+        complexity, width = self.levels[level]
+        print(f"[adaptive] {direction}: livello {self.level} -> {level} (complessità {complexity}, larghezza {width or 'camera'}), "
+              f"latenza media {self._latency * 1000:.1f} ms, budget {self._budget * 1000:.1f} ms, inferenze {self._inference_fps:.1f}/s", flush=True)
+
+        self._last_switch_was_up = level < self.level
+        self.level = level
+        self._latency = None
+        self._frames_since_switch = 0
+        return self.levels[level]
+
+class FingerClassifier(ABC):
+    ##
+    # Interfaccia dei classificatori che contano le dita aperte: count_fingers riceve le coordinate (21, 2)
+    # in pixel dei landmark di una mano e restituisce un numero da 0 a 5
+    ##
+    @abstractmethod
+    def count_fingers(self, landmarks):
+        pass
+
+class RuleClassifier(FingerClassifier):
+    ##
+    # Un dito è aperto se la distanza tra la punta e il polso è maggiore della distanza tra la nocca e il polso.
+    # Il pollice è aperto se la distanza tra la punta e il landmark 17 è maggiore della distanza tra il landmark 17
+    # e il polso più un certo margine. Le distanze vengono confrontate al quadrato per evitare le radici
+    ##
+    def count_fingers(self, landmarks):
+        # Con un'unica indicizzazione ottengo punte, nocche e landmark 17 rispetto al polso
+        from_wrist = landmarks[Constants.FEATURE_LANDMARKS] - landmarks[Constants.WRIST]
+        sq_dist_from_wrist = (from_wrist * from_wrist).sum(axis=1)
+
+        open_fingers = np.count_nonzero(sq_dist_from_wrist[0:4] > sq_dist_from_wrist[4:8])
+
+        thumb = landmarks[Constants.THUMB_TIP] - landmarks[Constants.PINKY_BASE]
+        thumb_open = thumb.dot(thumb) > sq_dist_from_wrist[8] * Constants.THUMB_MARGIN ** 2
+
+        return int(open_fingers) + int(thumb_open)
+
+class LinearClassifier(FingerClassifier):
+    ##
+    # Modello lineare (regressione ridge uno-contro-tutti, solo NumPy) addestrato su sessioni registrate.
+    # Le feature sono invarianti a posizione, scala, rotazione e mano usata: i landmark vengono espressi rispetto
+    # al polso, nel sistema di riferimento che ha come asse la direzione polso-nocca del medio e come unità la sua
+    # lunghezza, con la coordinata trasversale orientata sempre verso il mignolo, così mano destra e sinistra coincidono
+    ##
+    CLASSES = 6
+    # Polso, nocca del medio e base del mignolo, che definiscono il sistema di riferimento della mano
+    FRAME_LANDMARKS = np.array([Constants.WRIST, Constants.MIDDLE_BASE, Constants.PINKY_BASE])
+
+    def __init__(self, weights):
+        # Matrice (41, CLASSES): 20 coordinate longitudinali, 20 trasversali e il termine noto
+        self._weights = weights
+
+        ##
+        # Per classificare non calcolo le feature: i punteggi sono lineari nei landmark una volta fissato il sistema
+        # di riferimento, quindi traslazione e proiezioni vengono incorporate nei pesi. Il prodotto tra i landmark in
+        # pixel e la matrice (42, 4 * CLASSES) dà le somme pesate di x e y con i pesi longitudinali e trasversali,
+        # che combinate con le componenti dell'asse della mano danno i punteggi moltiplicati per il quadrato della
+        # lunghezza dell'asse. La coordinata longitudinale della nocca del medio vale sempre 1, quindi il termine noto
+        # (anche lui da moltiplicare per quel quadrato) si somma al suo peso
+        ##
+        along = weights[0:20].copy()
+        along[Constants.MIDDLE_BASE - 1] += weights[40]
+        across = weights[20:40]
+
+        projection = np.zeros((42, 4 * LinearClassifier.CLASSES))
+        classes = LinearClassifier.CLASSES
+        projection[2::2, 0:classes] = along
+        projection[3::2, classes:2 * classes] = along
+        projection[2::2, 2 * classes:3 * classes] = across
+        projection[3::2, 3 * classes:4 * classes] = across
+        # Le righe del polso sottraggono la sua posizione da tutti gli altri landmark
+        projection[0] = -projection[2::2].sum(axis=0)
+        projection[1] = -projection[3::2].sum(axis=0)
+        self._projection = projection
+
+    @staticmethod
+    def features(landmarks):
+        # Restituisce una matrice (20, 2) con le coordinate longitudinali e trasversali dei landmark rispetto al polso
+        from_wrist = (landmarks[1:] - landmarks[Constants.WRIST]).astype(np.float64)
+        axis = from_wrist[Constants.MIDDLE_BASE - 1]
+        sq_length = axis.dot(axis)
+        if sq_length == 0:
+            return np.zeros((20, 2))
+
+        # La perpendicolare all'asse è orientata verso la base del mignolo
+        perpendicular = np.array([-axis[1], axis[0]])
+        if from_wrist[Constants.PINKY_BASE - 1].dot(perpendicular) < 0:
+            perpendicular = -perpendicular
+
+        return np.stack([from_wrist @ axis, from_wrist @ perpendicular], axis=1) / sq_length
+
+    def count_fingers(self, landmarks):
+        (wrist_x, wrist_y), (middle_x, middle_y), (pinky_x, pinky_y) = landmarks[LinearClassifier.FRAME_LANDMARKS].tolist()
+        axis_x, axis_y = middle_x - wrist_x, middle_y - wrist_y
+        side = 1 if axis_x * (pinky_y - wrist_y) - axis_y * (pinky_x - wrist_x) >= 0 else -1
+
+        sums = (landmarks.ravel() @ self._projection).reshape(4, LinearClassifier.CLASSES)
+        scores = np.array((axis_x, axis_y, -side * axis_y, side * axis_x)) @ sums
+        return int(scores.argmax())
+
+    @staticmethod
+    def train(landmarks, labels, regularization=Constants.CLASSIFIER_REGULARIZATION):
+        # landmarks è un array (N, 21, 2) in pixel, labels un array di N numeri da 0 a 5
+        design = np.empty((len(landmarks), 41))
+        for i, hand in enumerate(landmarks):
+            features = LinearClassifier.features(hand)
+            design[i, 0:20] = features[:, 0]
+            design[i, 20:40] = features[:, 1]
+        design[:, 40] = 1
+
+        targets = np.zeros((len(labels), LinearClassifier.CLASSES))
+        targets[np.arange(len(labels)), labels] = 1
+
+        weights = np.linalg.solve(design.T @ design + regularization * np.eye(41), design.T @ targets)
+        return LinearClassifier(weights)
+
+    def save(self, path):
+        np.savez(path, weights=self._weights)
+
+    @staticmethod
+    def load(path):
+        return LinearClassifier(np.load(path)["weights"])
+
+    @staticmethod
+    def load_sessions(paths):
+        # Restituisce landmark in pixel ed etichette di tutti i frame con una mano delle sessioni registrate con un'etichetta
+        all_landmarks, all_labels = [], []
+        for path in paths:
+            session = np.load(path)
+            label = int(session["label"]) if "label" in session else -1
+            if label < 0:
+                print(f"{path}: sessione senza etichetta (--record-label), ignorata", flush=True)
+                continue
+
+            landmarks = session["landmarks"]
+            landmarks = landmarks[~np.isnan(landmarks).any(axis=(1, 2))] * session["window_size"]
+            all_landmarks.append(landmarks)
+            all_labels.append(np.full(len(landmarks), label))
+            print(f"{path}: {len(landmarks)} frame con {label} dita", flush=True)
+
+        if not all_landmarks:
+            return np.zeros((0, 21, 2)), np.zeros(0, dtype=np.int64)
+        return np.concatenate(all_landmarks), np.concatenate(all_labels)
+
+    @staticmethod
+    def train_from_sessions(paths, output_path):
+        ##
+        # Addestra il modello sulle sessioni indicate, tenendo da parte un campione ogni CLASSIFIER_VALIDATION_STEP
+        # per confrontare l'accuratezza con le regole geometriche, poi lo riaddestra su tutti i campioni e lo salva
+        ##
+        landmarks, labels = LinearClassifier.load_sessions(paths)
+        if len(landmarks) == 0:
+            print("Nessun frame etichettato, modello non addestrato", flush=True)
+            return None
+
+        validation = np.zeros(len(landmarks), dtype=bool)
+        validation[::Constants.CLASSIFIER_VALIDATION_STEP] = True
+        model = LinearClassifier.train(landmarks[~validation], labels[~validation])
+
+        rules = RuleClassifier()
+        for name, classifier in (("modello", model), ("regole", rules)):
+            predictions = np.array([classifier.count_fingers(hand) for hand in landmarks[validation]])
+            print(f"Accuratezza {name} in validazione: {np.mean(predictions == labels[validation]) * 100:.1f}%", flush=True)
+
+        model = LinearClassifier.train(landmarks, labels)
+        model.save(output_path)
+        print(f"Modello salvato in {output_path}", flush=True)
+        return model
+
 class handTracker():
-    def __init__(self, mode=False, maxHands=1, detectionCon=0.5, modelComplexity=1, trackCon=0.5):
+    def __init__(self, mode=False, maxHands=1, detectionCon=0.5, modelComplexity=1, trackCon=0.5,
+                 inference_width=Constants.INFERENCE_WIDTH, use_roi=False, roi_margin=Constants.ROI_MARGIN, motion_gate=None,
+                 adaptive_fps=0, classifier=None, load_model=True):
         # Inizializzazione del tracker con i parametri forniti
         self.mode = mode
         self.maxHands = maxHands
         self.detectionCon = detectionCon
         self.modelComplex = modelComplexity
         self.trackCon = trackCon
-        self.current_lm_list = []
+        self.inference_width = inference_width
+        self.use_roi = use_roi
+        self.roi_margin = roi_margin
+        # Regione (x0, y0, x1, y1) in pixel in cui cercare la mano nel frame successivo, None per cercarla su tutto il frame
+        self._roi = None
+        # Se presente, permette di saltare l'inferenza sui frame in cui la scena non è cambiata
+        self.motion_gate = motion_gate
+        # Buffer riutilizzati per l'immagine ridotta e per la sua conversione in RGB
+        self._scratch = ScratchBuffers()
+        # Se adaptive_fps è positivo, complessità e risoluzione vengono adattate per mantenere quei frame al secondo
+        self.adaptive = None
+        if adaptive_fps > 0:
+            self.adaptive = ComplexityController(adaptive_fps, modelComplexity, inference_width)
+        # Coordinate (x, y) in pixel dei 21 landmark della mano, None se non c'è nessuna mano
+        self.landmarks = None
+        # Le stesse coordinate normalizzate tra 0 e 1 rispetto all'intero frame
+        self.normalized_landmarks = None
+        self._finger_count = None
+        # Classificatore usato per contare le dita (di default le regole geometriche)
+        self.classifier = classifier if classifier is not None else RuleClassifier()
 
+        # Senza modello il tracker può solo ricevere landmark già calcolati (ad esempio durante il replay di una sessione),
+        # a meno che il modello non venga caricato in seguito con load_model
+        if load_model:
+            self.load_model()
+
+    def load_model(self):
         # Inizializzazione di Mediapipe per il rilevamento delle mani
         self.mpHands = mp.solutions.hands
-        self.hands = self.mpHands.Hands(self.mode, self.maxHands, self.modelComplex,
-                                        self.detectionCon, self.trackCon)
+        # Un'istanza per ogni complessità usata, così il cambio di complessità non ricarica il modello
+        self._models = {}
+        self.set_model_complexity(self.modelComplex)
         self.mpDraw = mp.solutions.drawing_utils
 
+    def warm_up(self, size):
+        ##
+        # Carica il modello, se non è già stato fatto, ed esegue un'inferenza su un'immagine nera della dimensione
+        # (larghezza, altezza) della camera: la prima inferenza inizializza il grafo di Mediapipe e alloca i buffer,
+        # quindi così il costo non ricade sul primo frame reale
+        ##
+        if not hasattr(self, "hands"):
+            self.load_model()
+        width, height = size
+        self.process_region(np.zeros((height, width, 3), dtype=np.uint8), (0, 0, width, height))
+
+    def set_model_complexity(self, modelComplexity):
+        if modelComplexity not in self._models:
+            self._models[modelComplexity] = self.mpHands.Hands(self.mode, self.maxHands, modelComplexity,
+                                                               self.detectionCon, self.trackCon)
+        self.modelComplex = modelComplexity
+        self.hands = self._models[modelComplexity]
+
     def handsFinder(self, image, draw=True):
+        height, width, _ = image.shape
+
+        # Se la scena non è cambiata riutilizzo i risultati dell'ultima inferenza
+        if self.motion_gate is not None and not self.motion_gate.needs_inference(image):
+            if draw:
+                self.drawHands(image)
+            return image
+
+        inference_start = time.perf_counter()
+
+        # Se nel frame precedente c'era una mano cerco solo attorno ad essa, altrimenti su tutto il frame
+        if self.use_roi and self._roi is not None:
+            self.results = self.process_region(image, self._roi)
+            # Se ho perso la mano nella regione ripeto la ricerca su tutto il frame
+            if not self.results.multi_hand_landmarks:
+                self.results = self.process_region(image, (0, 0, width, height))
+        else:
+            self.results = self.process_region(image, (0, 0, width, height))
+
+        if self.use_roi:
+            self._roi = self.get_hand_region(width, height)
+
+        # Il cambio di livello mantiene risultati, landmark e regione della mano, quindi il tracciamento prosegue
+        if self.adaptive is not None:
+            new_level = self.adaptive.update(time.perf_counter() - inference_start)
+            if new_level is not None:
+                complexity, self.inference_width = new_level
+                self.set_model_complexity(complexity)
+
+        if draw:
+            self.drawHands(image)
+        return image
+
+    def process_region(self, image, region):
+        ##
+        # Esegue Mediapipe sulla regione (x0, y0, x1, y1) dell'immagine ridotta a inference_width, poi riporta
+        # le coordinate normalizzate dei landmark rispetto all'intera immagine, così sono indipendenti da ritaglio e scala
+        ##
+        height, width, _ = image.shape
+        x0, y0, x1, y1 = region
+        crop = image[y0:y1, x0:x1]
+
+        crop_width = x1 - x0
+        if self.inference_width and crop_width > self.inference_width:
+            crop_height = y1 - y0
+            inference_height = max(1, round(self.inference_width * crop_height / crop_width))
+            crop = cv2.resize(crop, (self.inference_width, inference_height),
+                              dst=self._scratch.get("inference", (inference_height, self.inference_width, 3)),
+                              interpolation=cv2.INTER_AREA)
+
         # Converte l'immagine da BGR a RGB
-        imageRGB = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        imageRGB = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB, dst=self._scratch.get("rgb", crop.shape))
         # Processa l'immagine per rilevare le mani
-        self.results = self.hands.process(imageRGB)
+        results = self.hands.process(imageRGB)
+
+        if results.multi_hand_landmarks and (x0, y0, x1, y1) != (0, 0, width, height):
+            scale_x, scale_y = (x1 - x0) / width, (y1 - y0) / height
+            offset_x, offset_y = x0 / width, y0 / height
+            for handLms in results.multi_hand_landmarks:
+                for lm in handLms.landmark:
+                    lm.x = offset_x + lm.x * scale_x
+                    lm.y = offset_y + lm.y * scale_y
+
+        return results
+
+    def get_hand_region(self, width, height, handNo=0):
+        # Restituisce il riquadro quadrato della mano allargato di roi_margin, limitato ai bordi dell'immagine
+        if not self.results.multi_hand_landmarks:
+            return None
+
+        Hand = self.results.multi_hand_landmarks[handNo]
+        points = np.array([(lm.x, lm.y) for lm in Hand.landmark]) * (width, height)
+        (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+
+        half_side = max(max_x - min_x, max_y - min_y) * (0.5 + self.roi_margin)
+        center_x, center_y = (min_x + max_x) / 2, (min_y + max_y) / 2
+
+        x0, y0 = max(0, int(center_x - half_side)), max(0, int(center_y - half_side))
+        x1, y1 = min(width, int(center_x + half_side) + 1), min(height, int(center_y + half_side) + 1)
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return None
+        return (x0, y0, x1, y1)
+
+    def drawHands(self, image):
+        # Le coordinate sono normalizzate, quindi posso disegnare su un'immagine di qualunque dimensione
         if self.results.multi_hand_landmarks:
             for handLms in self.results.multi_hand_landmarks:
                 # Disegna i landmark e le connessioni delle mani sull'immagine
-                if draw:
-                    self.mpDraw.draw_landmarks(
-                        image, handLms, self.mpHands.HAND_CONNECTIONS)
-        return image
+                self.mpDraw.draw_landmarks(
+                    image, handLms, self.mpHands.HAND_CONNECTIONS)
 
-    def compute_landmarks(self, image):
-        # A ogni iterazione svuoto la lista dei landmarks
-        self.current_lm_list = []
-        
-        # Trova e disegna le posizioni dei landmark delle mani sull'immagine
-        self.positionFinder(image)
-
-    # restituisce la lista di landmarks sulla mano
-    def positionFinder(self, image, handNo=0, draw=True):
+    def compute_landmarks(self, size, image=None):
+        # Trova le posizioni dei landmark delle mani e, se è presente un'immagine, le disegna
+        self.positionFinder(size, image, draw=image is not None)
 
+    # restituisce i landmarks sulla mano come array (21, 2), espressi in pixel rispetto alla dimensione size (larghezza, altezza)
+    def positionFinder(self, size, image=None, handNo=0, draw=True):
+        normalized = None
         if self.results.multi_hand_landmarks:
             Hand = self.results.multi_hand_landmarks[handNo]
-            for id, lm in enumerate(Hand.landmark):
-                # Ottiene le coordinate normalizzate dei landmark e le converte in pixel
-                h, w, _ = image.shape
-                cx, cy = int(lm.x * w), int(lm.y * h)
-                self.current_lm_list.append([id, cx, cy])
+            normalized = np.array([(lm.x, lm.y) for lm in Hand.landmark])
+
+        self.set_landmarks(normalized, size)
+
+        if draw and image is not None:
+            self.drawPositions(image)
+
+    def drawPositions(self, image):
+        if self.landmarks is not None:
+            for id, (cx, cy) in enumerate(self.landmarks.tolist()):
                 # Disegna un cerchio intorno al landmark sull'immagine
-                if draw:
-                    cv2.circle(image, (cx, cy), 10, (255, 0, 255), cv2.FILLED)
-                    # Scrive l'ID del landmark all'interno del cerchio
-                    cv2.putText(image, str(id), (cx - 5, cy + 5),
-                                cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
+                cv2.circle(image, (cx, cy), 10, (255, 0, 255), cv2.FILLED)
+                # Scrive l'ID del landmark all'interno del cerchio
+                cv2.putText(image, str(id), (cx - 5, cy + 5),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
+
+    def set_landmarks(self, normalized, size):
+        # A ogni iterazione svuoto i landmarks e le feature calcolate sul frame precedente
+        self.normalized_landmarks = normalized
+        self.landmarks = None
+        self._finger_count = None
+
+        # Converte le coordinate normalizzate dei landmark in pixel
+        if normalized is not None:
+            w, h = size
+            self.landmarks = (normalized * (w, h)).astype(np.int64)
+
+    def has_hand(self):
+        return self.landmarks is not None
 
     def get_lm_coords(self, id):
-        return (self.current_lm_list[id][1], self.current_lm_list[id][2])
+        return tuple(self.landmarks[id].tolist())
+
+    def get_finger_count(self):
+        # Il numero di dita viene calcolato una sola volta per frame e riutilizzato fino al frame successivo
+        if self._finger_count is None:
+            self._finger_count = self.classifier.count_fingers(self.landmarks)
+
+        return self._finger_count
 
 class GestureController:
 
-    def __init__(self):
-        self._current_mode = Mode.MANUAL
-        self._mqtt_manager = MqttManager(self)
+    def __init__(self, tracker=None, mqtt_client=None, mode=None):
+        # La modalità va impostata prima di creare l'MqttManager, che la pubblica subito su /mode
+        self._current_mode = mode if mode is not None else Mode.MANUAL
+        self._mqtt_manager = MqttManager(self, client=mqtt_client)
 
-        self._tracker = handTracker()
+        self._tracker = tracker if tracker is not None else handTracker()
 
         self._changing_mode = False
-        self._mean_counter = 0
-        self._meanPos = 0
+        # Target fissato dal voto (stringa con il numero), None se non è ancora stato calcolato
+        self._mean_pos = None
+        self._target_vote = TargetVote()
+        # Frame consecutivi con la mano chiusa o assente durante il calcolo
+        self._missed_frames = 0
+        # Diventa vero se dopo aver fissato il target la mano viene chiusa: alla riapertura si ricalcola
+        self._restart_vote = False
+        self._vote_start = 0
+        # Orologio usato per le metriche, sostituito dal replay con l'istante dei frame registrati
+        self._clock = time.monotonic
         
         self._last_operation = ""
         self._reached = False
         self._counter = 0
         self._image = None
+        # Buffer delle immagini mostrate nella finestra, restituiti al pool dopo essere stati mostrati
+        self._window_pool = FramePool()
           
         self._pos = (0,0)
         self._orient = 0
 
-    def get_index_direction(self):
+        # Se presente, registra i landmark (ed eventualmente i frame) di ogni immagine elaborata
+        self._recorder = None
+
+        # Se presente, anteprima di rete su cui vengono inviate le immagini annotate
+        self._preview = None
+
+        # Filtro della direzione in modalità manuale, sostituibile per cambiarne finestra e isteresi
+        self._direction_filter = DirectionFilter()
+
+    def get_index_direction(self, filtered=False):
 
         wirst_x, wirst_y = self._tracker.get_lm_coords(0)
         index_x, index_y = self._tracker.get_lm_coords(8)
         
-        slope = MathUtils.get_slope((wirst_x, wirst_y), (index_x, index_y))
-
         # Se l'indice si trova in posizione più bassa rispetto al polso, cambio modalità
         if index_y > wirst_y:
+            slope = MathUtils.get_slope((wirst_x, wirst_y), (index_x, index_y))
             if slope < -2 or slope > 2:
                 return -1
             else:
+                # Anche questo STOP è immediato e azzera il filtro della direzione
+                if filtered:
+                    self._direction_filter.reset()
                 return Command.STOP
 
-        # Se il coefficiente angolare è compreso tra 1 e -1, differenzio tra sinistra e destra in base a quale x è maggiore tra polso e indice
-        if slope < 1 and slope > -1:
-            if index_x > wirst_x:
-                return Command.RIGHT
-            return Command.LEFT
-
-        if slope > 1 and slope < 3:
-            return Command.FRONTLEFT
-
-        if slope < -3 or slope > 3:
-            return Command.FRONT
+        # Angolo dell'indice rispetto al polso (l'asse y dell'immagine è rivolto verso il basso): gli intervalli
+        # corrispondono ai coefficienti angolari 1 e 3, cioè 45° e circa 71.6° da ciascun lato
+        angle = math.degrees(math.atan2(wirst_y - index_y, index_x - wirst_x))
 
-        # L'ultimo caso rimasto è slope > -3 and slope < -1
-        return Command.FRONTRIGHT
+        if filtered:
+            return self._direction_filter.update(angle)
+        return DirectionFilter.get_command(angle)
 
     def get_hand_mean(self):
         ##
-        # Essendo l'apertura della mano un'operazione potenzialmente lenta, utilizziamo una media pesata in cui i valori finali hanno un peso più elevato
-        # in questo modo si da più importanza ai valori alla fine dell'apertura, che deve impiegare non più di MEAN_DIMENSION/CAM_REFRESH_TIME millisecondi
+        # Essendo l'apertura della mano un'operazione potenzialmente lenta, utilizziamo un voto pesato in cui i valori finali hanno un peso più elevato.
+        # Il target viene fissato appena il numero più votato ha un margine sufficiente sugli altri, al più tardi dopo MEAN_DIMENSION frame
         ##
 
-        # Caso in cui avevo finito di calcolare la posizione oppure avevo interrotto il calcolo
-        if (self._mean_counter == 0 or self._mean_counter == -1):
-            self._mean_counter = 1
-            self._mean_pos = int(0)
-            return Command.STOP
+        if (self._mean_pos is not None):
+            # Caso in cui ho finito di calcolare il target ma ho ancora la mano aperta (anche se indico un altro numero, viene mantenuto quello calcolato)
+            # l'unico modo per ricalcolare un nuovo numero è chiudere la mano
+            if (not self._restart_vote):
+                return self._mean_pos
+
+            # La mano è stata chiusa e poi riaperta: inizio un nuovo calcolo
+            self._mean_pos = None
+            self._restart_vote = False
+            self._target_vote.reset()
+
+        # Caso in cui inizio il calcolo
+        if (self._target_vote.frames == 0):
+            self._vote_start = self._clock()
+
+        # Caso in cui sto calcolando il voto
+        self._missed_frames = 0
+        self._target_vote.add(self.calculate_number())
+
+        # Caso in cui il voto è abbastanza sicuro (o la finestra è piena) e posso restituire la posizione
+        confident = self._target_vote.frames >= Constants.MIN_VOTE_FRAMES and self._target_vote.margin() >= Constants.VOTE_CONFIDENCE
+        if (confident or self._target_vote.is_full()):
+            self._mean_pos = str(self._target_vote.winner())
+            self.publish_time_to_commit()
+            return self._mean_pos
 
-        # Caso in cui sto calcolando la media
-        if (self._mean_counter < Constants.MEAN_DIMENSION and self._mean_counter > 0):
-            self._mean_pos += self.calculate_number() * self._mean_counter
-            self._mean_counter += 1
+        return "Calcolando"
+
+    def missed_hand_frame(self):
+        # Se chiudo la mano (o la perdo) durante il calcolo tollero qualche frame prima di azzerarlo
+        if (self._target_vote.frames > 0 and self._missed_frames < Constants.MAX_MISSED_FRAMES):
+            self._missed_frames += 1
             return "Calcolando"
 
-        # Caso in cui sono arrivato alla fine del calcolo della media e posso restituire la posizione
-        if (self._mean_counter == Constants.MEAN_DIMENSION):
-            self._mean_pos = str(
-                round(int(self._mean_pos) / Constants.MEAN_DENOM))
-            self._mean_counter += 1
-            return str(self._mean_pos)
+        self._target_vote.reset()
+        self._missed_frames = 0
+        return Command.STOP
 
-        # Caso in cui ho finito di calcolare la media ma ho ancora la mano aperta (anche se indico un altro numero, viene mantenuto quello calcolato)
-        # l'unico modo per ricalcolare un nuovo numero è chiudere la mano
-        return str(self._mean_pos)
+    def publish_time_to_commit(self):
+        time_to_commit = self._clock() - self._vote_start
+        print(f"Target {self._mean_pos} fissato in {time_to_commit:.3f} s ({self._target_vote.frames} frame)", flush=True)
+        self._mqtt_manager._client.publish("/gesture_metrics", dumps({
+            "time_to_commit": round(time_to_commit, 4), "frames": self._target_vote.frames, "target": self._mean_pos}))
 
     def change_mode(self):
         self._changing_mode = True
@@ -185,8 +961,12 @@ class GestureController:
             self._current_mode = Mode.AUTO
         else:
             self._current_mode = Mode.MANUAL
-            self._mean_counter = 0
-            self._mean_pos = Command.STOP
+            self._mean_pos = None
+            self._restart_vote = False
+            self._target_vote.reset()
+
+        # Il primo comando dopo il cambio di modalità va sempre pubblicato, anche se uguale all'ultimo
+        self._last_operation = ""
 
         print("Changing Mode in " + self._current_mode.name)
         self._mqtt_manager._client.publish("/mode", self._current_mode.name)
@@ -194,7 +974,7 @@ class GestureController:
     def compute_operation(self):
 
         # Se l'indice si trova sotto al polso, allora cambio modalità
-        if (self._tracker.current_lm_list and self.get_index_direction() == -1):
+        if (self._tracker.has_hand() and self.get_index_direction() == -1):
             if (not self._changing_mode):
                 self.change_mode()
             return Command.STOP
@@ -209,81 +989,75 @@ class GestureController:
         ##
         
         if self._current_mode == Mode.MANUAL:
-            # Se faccio il pugno in modalità manuale oppure rimuovo le mani dalla finestra il robot si ferma
-            if (not self._tracker.current_lm_list or self.calculate_number() == 0):
+            # Se faccio il pugno in modalità manuale oppure rimuovo le mani dalla finestra il robot si ferma subito
+            if (not self._tracker.has_hand() or self.calculate_number() == 0):
+                self._direction_filter.reset()
                 return Command.STOP
 
-            # Sennò calcolo e restituisco la direzione
-            return self.get_index_direction()
+            # Sennò calcolo e restituisco la direzione filtrata
+            return self.get_index_direction(filtered=True)
         
         ##
         # Se sono in modalità automatica
         ##
         
         # Se chiudo il pugno o rimuovo le mani dalla finestra ho tre possibilità
-        if (not self._tracker.current_lm_list or self.calculate_number() == 0):
+        if (not self._tracker.has_hand() or self.calculate_number() == 0):
             
             # Se ho raggiunto il target e ho la mano chiusa o fuori dall'inquadratura scrivo arrivato 
             if(self._reached):
                 return "Arrivato"
             
             # Se torno al pugno chiuso quando ho già finito di calcolare la posizione, continuo a mantenere la posizione calcolata
-            if (self._mean_counter == Constants.MEAN_DIMENSION + 1 or self._mean_counter == -1):
-                self._mean_counter = -1
-                return str(self._mean_pos)
+            if (self._mean_pos is not None):
+                self._restart_vote = True
+                return self._mean_pos
 
-            # Se chiudo la mano prima che la posizione sia stata calcolata, azzero il calcolo
-            self._mean_counter = 0
-            return Command.STOP
+            # Se chiudo la mano prima che la posizione sia stata calcolata, azzero il calcolo (dopo qualche frame di tolleranza)
+            return self.missed_hand_frame()
 
         # Se ho raggiunto il target e ho la mano aperta, reinizializzo il calcolo
         if(self._reached):
-            self._mean_counter = 0
+            self._mean_pos = None
+            self._restart_vote = False
+            self._target_vote.reset()
             self._reached = False
             return "Arrivato"
             
         return self.get_hand_mean()
         
     def calculate_number(self):
+        return self._tracker.get_finger_count()
 
-        number = 0
+class ImageUtils:
+    @staticmethod
+    def open_camera(index, width=Constants.CAPTURE_WIDTH, height=Constants.CAPTURE_HEIGHT, fps=Constants.TARGET_FPS):
+        # Chiede alla camera risoluzione, frequenza, codec e buffer adatti all'inferenza, poi legge quanto è stato concesso
+        # (i driver ignorano in silenzio le proprietà che non supportano)
+        device = cv2.VideoCapture(index)
+        if not device.isOpened():
+            print(f"Impossibile aprire la camera {index}", flush=True)
+            return device
 
-        wirst = self._tracker.get_lm_coords(0)
+        device.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*Constants.CAPTURE_FOURCC))
+        device.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        device.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        device.set(cv2.CAP_PROP_FPS, fps)
+        device.set(cv2.CAP_PROP_BUFFERSIZE, Constants.CAPTURE_BUFFER_SIZE)
 
-        # l'indice è aperto se la distanza tra la punta e il polso è maggiore della distanza tra la nocca e il polso
-        index_tip = self._tracker.get_lm_coords(8)
-        index_knuckle = self._tracker.get_lm_coords(6)
-        if MathUtils.distance(wirst, index_tip) > MathUtils.distance(wirst, index_knuckle):
-            number += 1
-            
-        # verifico se il medio è aperto
-        middle_tip = self._tracker.get_lm_coords(12)
-        middle_knucle = self._tracker.get_lm_coords(10)
-        if MathUtils.distance(wirst, middle_tip) > MathUtils.distance(wirst, middle_knucle):
-            number += 1
-            
-        # verifico se l'anulare è aperto
-        ring_tip = self._tracker.get_lm_coords(16)
-        ring_knucle = self._tracker.get_lm_coords(14)
-        if MathUtils.distance(wirst, ring_tip) > MathUtils.distance(wirst, ring_knucle):
-            number += 1
-            
-        # verifico se il mignolo è aperto
-        pinky_tip = self._tracker.get_lm_coords(20)
-        pinky_knucle = self._tracker.get_lm_coords(18)
-        if MathUtils.distance(wirst, pinky_tip) > MathUtils.distance(wirst, pinky_knucle):
-            number += 1
-            
-        # il pollice è aperto se la distanza tra la punta e il landmark 17 è maggiore della distanza tra il landmark 17 e il polso più un certo margine
-        # (quest'ultima usata come unità di misura anche se non rappresenta esattamente la distanza del pollice dal centro)
-        thumb_tip = self._tracker.get_lm_coords(4)
-        lm_17 = self._tracker.get_lm_coords(17)
-        if MathUtils.distance(thumb_tip, lm_17) > MathUtils.distance(wirst, lm_17) * 1.1:
-            number += 1
-            
-        return number
+        granted_fourcc = int(device.get(cv2.CAP_PROP_FOURCC))
+        granted_fourcc = "".join(chr((granted_fourcc >> (8 * i)) & 0xFF) for i in range(4)) if granted_fourcc > 0 else "?"
+        granted_width = int(device.get(cv2.CAP_PROP_FRAME_WIDTH))
+        granted_height = int(device.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        print(f"Camera {index}: richiesti {width}x{height} a {fps} FPS ({Constants.CAPTURE_FOURCC}), "
+              f"concessi {granted_width}x{granted_height} a {device.get(cv2.CAP_PROP_FPS):.0f} FPS ({granted_fourcc}), "
+              f"buffer {int(device.get(cv2.CAP_PROP_BUFFERSIZE))}", flush=True)
+
+        if granted_width * granted_height > width * height:
+            print("La camera non supporta la risoluzione richiesta, i pixel in più verranno scartati prima dell'inferenza", flush=True)
+
+        return device
 
-class ImageUtils:
     @staticmethod
     def write_on_image(image, string, pos, orientation, mode: Mode):
         if isinstance(string, Command):
@@ -304,26 +1078,45 @@ class ImageUtils:
                     cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1)
         
     @staticmethod
-    def capture_image(device: cv2.VideoCapture, gesture_controller: GestureController, is_from_phone: bool):
-        _, image = device.read()
-
-        # Ho bisogno di sapere se l'immagine viene da DroidCAM perché in tal caso la devo ribaltare
-        if(is_from_phone):
-           image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE) 
-        # Riflette l'immagine a specchio
-        image = cv2.flip(image, 1)  # 1 indica il riflesso orizzontale
-        
-        # Rileva e disegna le mani sull'immagine
-        image = gesture_controller._tracker.handsFinder(image)
+    def process_image(image, gesture_controller: GestureController, headless=False):
+        # Rileva le mani sull'immagine a piena risoluzione (il tracker la riduce prima dell'inferenza)
+        gesture_controller._tracker.handsFinder(image, draw=False)
         
         height, width, _ = image.shape
         new_height = int(Constants.WINDOW_WIDTH * height / width)
-        image = cv2.resize(image, (Constants.WINDOW_WIDTH, new_height))
+        window_size = (Constants.WINDOW_WIDTH, new_height)
+
+        # I landmark vengono sempre espressi nelle coordinate della finestra, anche in modalità headless
+        # in cui non ridimensiono l'immagine, così la classificazione non cambia
+        gesture_controller._tracker.compute_landmarks(window_size)
+
+        # Il frame va registrato prima di disegnarci sopra
+        if gesture_controller._recorder is not None:
+            gesture_controller._recorder.add(gesture_controller._tracker.normalized_landmarks, window_size, image)
+
+        # In modalità headless non ridimensiono e non disegno nulla, a meno che l'immagine non serva per l'anteprima di rete
+        if headless and gesture_controller._preview is None:
+            gesture_controller._image = None
+            return
         
-        gesture_controller._tracker.compute_landmarks(image)
+        # Disegno le mani dopo il ridimensionamento, direttamente sull'immagine mostrata
+        image = cv2.resize(image, window_size, dst=gesture_controller._window_pool.acquire((new_height, Constants.WINDOW_WIDTH, 3)))
+        gesture_controller._tracker.drawHands(image)
+        gesture_controller._tracker.drawPositions(image)
                  
         gesture_controller._image = image
         
+    @staticmethod
+    def capture_image(reader: FrameReader, gesture_controller: GestureController, headless=False):
+        image = reader.read()
+        if image is None:
+            return False
+
+        ImageUtils.process_image(image, gesture_controller, headless)
+        # L'immagine mostrata è una copia ridimensionata, quindi il frame può tornare subito al pool
+        reader.release(image)
+        return True
+
     @staticmethod
     def show_image(image):
          # Mostra l'immagine risultante con le mani e i landmark rilevati
@@ -334,39 +1127,64 @@ class MqttManager:
     _gesture_controller: GestureController
     _client: mqtt.Client
 
-    def __init__(self, gesture_controller: GestureController, username="publisher", password="publisher", broker="localhost", port=1883):
+    def __init__(self, gesture_controller: GestureController, username="publisher", password="publisher", broker="localhost", port=1883, client=None):
         self._gesture_controller = gesture_controller
+        # Numero di sequenza dei target pubblicati in modalità automatica: con il broker parte dall'istante di avvio in
+        # millisecondi, così resta crescente anche se gesture viene riavviato e il controller può scartare i messaggi
+        # già ricevuti. Con un client già pronto (il replay) parte da 0, così due replay della stessa sessione
+        # pubblicano gli stessi messaggi
+        self._auto_seq = int(time.time() * 1000) if client is None else 0
+        # Istante di avvio del programma, usato per misurare il tempo fino al primo comando pubblicato
+        self._startup_start = None
 
-        self._client = mqtt.Client(username)
-        self._client.username_pw_set(username, password, )
+        # Se ricevo un client già pronto (ad esempio quello in memoria usato dal replay) non mi connetto al broker
+        if client is not None:
+            self._client = client
+        else:
+            self._client = mqtt.Client(username)
+            self._client.username_pw_set(username, password, )
+
+        # Le callback vanno assegnate prima della connessione, perché il loop di rete può chiamarle subito
         self._client.on_connect = self.on_connect
         self._client.on_message = self.on_message
+
+        if client is None:
+            self.connect(broker, port)
         
-        self._counter = 0
+        self._client.publish(
+            "/mode", self._gesture_controller._current_mode.name)
 
+    def connect(self, broker, port):
+        delay = Constants.MQTT_RETRY_MIN_DELAY
         while True:
             try:
                 result = self._client.connect(broker, port)
                 if result == 0:  # Connessione riuscita
-                    print("Connessione riuscita! Apertura della fotocamera..." +
-                          str(self._client.is_connected()))
+                    print("Connessione riuscita! " +
+                          str(self._client.is_connected()), flush=True)
                     self._client.loop_start()
                     break  # Esci dal ciclo while se la connessione ha successo
                 else:
                     print(
-                        f"Tentativo di connessione fallito. Codice di risultato: {result}")
+                        f"Tentativo di connessione fallito. Codice di risultato: {result}", flush=True)
             except Exception as e:
-                print(f"Connessione fallita, attendere l'avvio dei container")
+                print(f"Connessione fallita, attendere l'avvio dei container", flush=True)
 
-            # Aggiungi un ritardo prima del successivo tentativo di connessione
-            time.sleep(5)  # Puoi personalizzare il ritardo a tua discrezione
+            # Aspetto prima del successivo tentativo, raddoppiando l'attesa fino a MQTT_RETRY_MAX_DELAY
+            time.sleep(delay)
+            delay = min(delay * 2, Constants.MQTT_RETRY_MAX_DELAY)
 
-        self._client.publish(
-            "/mode", self._gesture_controller._current_mode.name)
+    def publish_command(self, topic, payload, qos=0, retain=False):
+        self._client.publish(topic, payload, qos, retain)
+
+        # Al primo comando stampo quanto tempo è passato dall'avvio (camera, modello e broker compresi)
+        if self._startup_start is not None:
+            print(f"Primo comando pubblicato dopo {time.monotonic() - self._startup_start:.2f} s dall'avvio", flush=True)
+            self._startup_start = None
 
     def on_connect(self, client, userdata, flags, rc):
         print("Connected with result code " + str(rc), flush=True)
-        self._client.subscribe("/gesture_confirm")
+        self._client.subscribe("/gesture_confirm", qos=1)
         self._client.subscribe("/position")
 
     def on_message(self, client, message, msg):
@@ -382,73 +1200,595 @@ class MqttManager:
             self._gesture_controller._orient = pos_orient_dict['orientation']
         
     def publish_operation(self, current_operation):
-        # Se sono in modalità automatica e l'operazione è diversa da Command.STOP, allora la ripeto all'infinito
+        ##
+        # In modalità automatica pubblico il target (o STOP) solo quando cambia: il controller lo memorizza e
+        # naviga con il proprio ciclo di controllo a frequenza fissa. Il messaggio è inviato con QoS 1 e ha un numero di
+        # sequenza, con cui il controller scarta le copie ripetute. Non è mantenuto dal broker: /mode non lo è, quindi
+        # un controller che si connette dopo resta in modalità manuale e il target non verrebbe comunque usato
+        ##
         if(self._gesture_controller._current_mode == Mode.AUTO):
-            if(current_operation == Command.STOP):
-                # Se l'operazione corrente è STOP e anche l'ultima inviata è STOP, allora non invio nulla
-                if(self._gesture_controller._last_operation == Command.STOP): 
-                    return
-                # Se l'ultima inviata non è STOP, invio STOP e setto l'ultima inviata come STOP
-                self._client.publish("/commands_auto", Command.STOP.value)
-                self._gesture_controller._last_operation = Command.STOP
+            if (self._gesture_controller._last_operation == current_operation):
                 return
             
-            # Se arrivo qui vuol dire che l'operazione attuale è una stringa contenente il numero, quindi pubblico all'infinito
+            # L'operazione è STOP oppure una stringa contenente il numero del target
+            target = str(Command.STOP.value) if current_operation == Command.STOP else current_operation
+            self._auto_seq += 1
+            self.publish_command("/commands_auto", dumps({"seq": self._auto_seq, "target": target}), qos=1)
             self._gesture_controller._last_operation = current_operation
-            if(self._counter == 5):
-                self._client.publish("/commands_auto", current_operation)
-                self._counter = 0
-            self._counter += 1
             return
         
         # Se arrivo qui vuol dire che sono in modalità manuale, quindi ripeto l'operazione solo se è diversa da quella precedente
         if(self._gesture_controller._last_operation != current_operation):
             print("Current operation: " + str(current_operation))
-            self._client.publish("/commands_manual", 
+            self.publish_command("/commands_manual",
                                  str(current_operation.value))
             self._gesture_controller._last_operation = current_operation 
 
-def main():
+class SessionRecorder:
+    ##
+    # Registra una sessione in un file .npz compatto e indicizzato: per ogni frame salva l'istante, i 21 landmark
+    # normalizzati (NaN se non c'è nessuna mano) e, se richiesto, il frame codificato in JPEG.
+    # I JPEG sono concatenati in un unico array di byte e frame_offsets indica dove inizia e finisce ciascuno
+    ##
 
-    # Inizializzazione della videocamera
-    device = cv2.VideoCapture(0)
-    is_from_phone = False
-    
-    # device = cv2.VideoCapture(1)
-    # is_from_phone = True
+    def __init__(self, path, save_frames=False, label=-1):
+        self._path = path
+        self._save_frames = save_frames
+        # Numero di dita mostrato durante tutta la sessione, usato per addestrare il classificatore (-1 se assente)
+        self._label = label
+        self._start = None
+        self._window_size = (0, 0)
 
-    # Inizializzazione gesture controller
-    gesture_controller = GestureController()
+        self._timestamps = []
+        self._landmarks = []
+        self._frames = []
 
-    while True:
+    def add(self, normalized_landmarks, window_size, image=None):
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+        self._window_size = window_size
 
-        time.sleep(Constants.CAM_REFRESH_TIME)
-        
-        # Leggo l'immagine dalla videocamera
-        ImageUtils.capture_image(device, gesture_controller, is_from_phone)       
+        self._timestamps.append(now - self._start)
+        if normalized_landmarks is None:
+            normalized_landmarks = np.full((21, 2), np.nan)
+        self._landmarks.append(normalized_landmarks)
 
-        # Calcolo l'operazione sulle mani
-        current_operation = gesture_controller.compute_operation()
-        
-        # Scrivo l'operazione calcolata sull'immagine e la mostro
-        ImageUtils.write_on_image(gesture_controller._image, current_operation, gesture_controller._pos, gesture_controller._orient, gesture_controller._current_mode)
-        ImageUtils.show_image(gesture_controller._image)
+        if self._save_frames and image is not None:
+            _, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, Constants.RECORD_JPEG_QUALITY])
+            self._frames.append(jpeg.ravel())
 
-        if(current_operation == "Calcolando" or current_operation == "Arrivato"):
-            current_operation = Command.STOP
-            
-        gesture_controller._mqtt_manager.publish_operation(current_operation)
-        
-        # Gestione della chiusura della finestra
-        key = cv2.waitKey(1) & 0xFF
-        if key == 27 or cv2.getWindowProperty("Video", cv2.WND_PROP_VISIBLE) < 1 or not gesture_controller._mqtt_manager._client.is_connected():
+    def save(self):
+        frame_offsets = np.zeros(len(self._frames) + 1, dtype=np.int64)
+        frame_offsets[1:] = np.cumsum([len(frame) for frame in self._frames])
+        frames = np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=np.uint8)
+
+        np.savez_compressed(self._path,
+                            timestamps=np.array(self._timestamps, dtype=np.float64),
+                            landmarks=np.array(self._landmarks, dtype=np.float32).reshape(-1, 21, 2),
+                            window_size=np.array(self._window_size, dtype=np.int64),
+                            frames=frames,
+                            frame_offsets=frame_offsets,
+                            label=np.int64(self._label))
+        print(f"Sessione salvata in {self._path}: {len(self._timestamps)} frame, {len(self._frames)} immagini", flush=True)
+
+class InMemoryMqttClient:
+    # Sostituisce il client paho durante il replay: i messaggi pubblicati vengono solo memorizzati
+    def __init__(self):
+        # Lista di tuple (istante, topic, payload)
+        self.messages = []
+        # Istante del frame in riproduzione, assegnato dal replay
+        self.now = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((self.now, topic, str(payload)))
+
+    def subscribe(self, topic):
+        pass
+
+    def is_connected(self):
+        return True
+
+class ReplayRunner:
+    ##
+    # Riproduce una sessione registrata attraverso handTracker, GestureController.compute_operation e
+    # MqttManager.publish_operation senza webcam né broker, misurando il tempo speso in ogni stadio.
+    # Se la sessione contiene i frame e use_frames è vero, Mediapipe viene eseguito di nuovo su ogni immagine,
+    # altrimenti vengono usati direttamente i landmark registrati
+    ##
+    STAGES = ["decode", "inference", "landmarks", "classify", "publish"]
+
+    def __init__(self, path, use_frames=False, tracker=None, mode=None, direction_filter=None, classifier=None):
+        self._session = np.load(path)
+        self._use_frames = use_frames and len(self._session["frames"]) > 0
+        if use_frames and not self._use_frames:
+            print("La sessione non contiene frame, uso i landmark registrati", flush=True)
+
+        if tracker is None:
+            tracker = handTracker(load_model=self._use_frames, classifier=classifier)
+        self._client = InMemoryMqttClient()
+        self._gesture_controller = GestureController(tracker, self._client, mode)
+        self._gesture_controller._clock = lambda: self._client.now
+        if direction_filter is not None:
+            self._gesture_controller._direction_filter = direction_filter
+
+        self._timings = {stage: [] for stage in ReplayRunner.STAGES}
+
+    def timed(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self._timings[stage].append(time.perf_counter() - start)
+        return result
+
+    def run(self):
+        tracker = self._gesture_controller._tracker
+        timestamps = self._session["timestamps"]
+        landmarks = self._session["landmarks"]
+        frames = self._session["frames"]
+        frame_offsets = self._session["frame_offsets"]
+        window_size = tuple(self._session["window_size"].tolist())
+
+        for i, timestamp in enumerate(timestamps.tolist()):
+            self._client.now = timestamp
+
+            if self._use_frames:
+                jpeg = frames[frame_offsets[i]:frame_offsets[i + 1]]
+                image = self.timed("decode", cv2.imdecode, jpeg, cv2.IMREAD_COLOR)
+                self.timed("inference", tracker.handsFinder, image, False)
+                self.timed("landmarks", tracker.compute_landmarks, window_size)
+            else:
+                normalized = None if np.isnan(landmarks[i]).any() else landmarks[i].astype(np.float64)
+                self.timed("landmarks", tracker.set_landmarks, normalized, window_size)
+
+            current_operation = self.timed("classify", self._gesture_controller.compute_operation)
+            self.timed("publish", handle_operation, self._gesture_controller, None, current_operation, True)
+
+        return self.report(timestamps)
+
+    def report(self, timestamps):
+        stages = {}
+        total = 0
+        for stage, samples in self._timings.items():
+            if not samples:
+                continue
+            samples_ms = np.array(samples) * 1000
+            stages[stage] = {"mean_ms": float(samples_ms.mean()),
+                             "p95_ms": float(np.percentile(samples_ms, 95)),
+                             "max_ms": float(samples_ms.max())}
+            total += samples_ms.mean()
+
+        duration = float(timestamps[-1] - timestamps[0]) if len(timestamps) > 1 else 0
+        topics = {}
+        for _, topic, _ in self._client.messages:
+            topics[topic] = topics.get(topic, 0) + 1
+
+        return {"frames": len(timestamps),
+                "duration_s": duration,
+                "recorded_fps": (len(timestamps) - 1) / duration if duration > 0 else 0,
+                "stages": stages,
+                # Frame al secondo sostenibili se ogni frame attraversa in serie tutti gli stadi misurati
+                "sustainable_fps": 1000 / total if total > 0 else 0,
+                "messages_per_topic": topics,
+                "messages_per_minute": {topic: count * 60 / duration for topic, count in topics.items()} if duration > 0 else {},
+                "commands": [{"t": round(t, 3), "topic": topic, "payload": payload} for t, topic, payload in self._client.messages]}
+
+    @staticmethod
+    def print_report(report):
+        print(f"Frame: {report['frames']}, durata: {report['duration_s']:.2f} s, FPS registrati: {report['recorded_fps']:.1f}")
+        for stage, stats in report["stages"].items():
+            print(f"  {stage:<10} media {stats['mean_ms']:.3f} ms, p95 {stats['p95_ms']:.3f} ms, max {stats['max_ms']:.3f} ms")
+        print(f"FPS sostenibili: {report['sustainable_fps']:.1f}")
+        print(f"Messaggi per topic: {report['messages_per_topic']}")
+        print("Messaggi al minuto: " + ", ".join(f"{topic} {rate:.1f}" for topic, rate in report["messages_per_minute"].items()))
+        for command in report["commands"]:
+            print(f"  {command['t']:>8.3f}  {command['topic']:<18} {command['payload']}")
+
+class GesturePipeline:
+    ##
+    # Esegue acquisizione, inferenza e visualizzazione/pubblicazione su tre stadi separati, collegati da code
+    # limitate in cui vince sempre il frame più recente. In questo modo la latenza tra il gesto e il comando
+    # è pari a un solo tempo di inferenza e non alla somma dei tempi di tutti gli stadi
+    ##
+
+    def __init__(self, device: cv2.VideoCapture, gesture_controller: GestureController, is_from_phone: bool,
+                 target_fps=Constants.TARGET_FPS, headless=False, stop_event=None):
+        self._reader = FrameReader(device, is_from_phone)
+        self._gesture_controller = gesture_controller
+        self._target_fps = target_fps
+        self._headless = headless
+
+        # I frame scartati dalle code restituiscono il proprio buffer al pool
+        self._frames = LatestQueue(on_drop=self._reader.release)
+        self._results = LatestQueue(on_drop=lambda result: gesture_controller._window_pool.release(result[0]))
+        self._stop = stop_event if stop_event is not None else threading.Event()
+
+    def capture_loop(self):
+        rate_limiter = RateLimiter(self._target_fps)
+        while not self._stop.is_set():
+            rate_limiter.wait()
+            image = self._reader.read()
+            if image is not None:
+                self._frames.put(image)
+
+    def inference_loop(self):
+        while not self._stop.is_set():
+            image = self._frames.get(timeout=0.1)
+            if image is None:
+                continue
+
+            ImageUtils.process_image(image, self._gesture_controller, self._headless)
+            self._reader.release(image)
+            current_operation = self._gesture_controller.compute_operation()
+
+            # compute_operation può cambiare modalità: pubblico qui, così il risultato viene pubblicato nella modalità
+            # in cui è stato calcolato e non in quella corrente quando lo stadio di visualizzazione lo riceve
+            publish_result(self._gesture_controller, current_operation)
+            self._results.put((self._gesture_controller._image, current_operation))
+
+    def run(self):
+        threads = [threading.Thread(target=self.capture_loop, daemon=True),
+                   threading.Thread(target=self.inference_loop, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        fps_meter = FpsMeter("pipeline")
+
+        # La visualizzazione resta sul thread principale perché highgui non supporta altri thread
+        try:
+            while not self._stop.is_set():
+                result = self._results.get(timeout=0.1)
+                if result is None:
+                    if not self._gesture_controller._mqtt_manager._client.is_connected():
+                        break
+                    continue
+
+                image, current_operation = result
+                if not handle_operation(self._gesture_controller, image, current_operation, self._headless, self._stop,
+                                        publish=False):
+                    break
+                fps_meter.tick()
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        print(f"Frame scartati: acquisizione {self._frames.dropped}, inferenza {self._results.dropped}")
+
+
+class PreviewServer:
+    ##
+    # Anteprima MJPEG delle immagini annotate, visibile da browser su http://host:porta/ da un numero qualsiasi
+    # di client. Lo stadio di visualizzazione copia l'immagine in un buffer (al massimo fps volte al secondo e
+    # solo se c'è almeno un client collegato); ridimensionamento e codifica JPEG avvengono su un thread dedicato,
+    # quindi non rallentano acquisizione e inferenza. Ogni client riceve sempre l'ultimo JPEG disponibile:
+    # un client lento salta i frame intermedi invece di accumulare ritardo
+    ##
+    def __init__(self, port, host="127.0.0.1", fps=Constants.PREVIEW_FPS, width=Constants.PREVIEW_WIDTH):
+        self._period = 1 / fps
+        self._width = width
+        self._next_frame = 0
+
+        self._pool = FramePool()
+        self._frames = LatestQueue(on_drop=self._pool.release)
+        self._scratch = ScratchBuffers()
+
+        # Ultimo JPEG codificato e numero progressivo, protetti dalla condizione su cui attendono i client
+        self._jpeg = None
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._viewers = 0
+        self._closed = threading.Event()
+
+        self._server = ThreadingHTTPServer((host, port), self.make_handler())
+        self._server.daemon_threads = True
+        self._threads = [threading.Thread(target=self._server.serve_forever, daemon=True),
+                         threading.Thread(target=self.encode_loop, daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        print(f"Anteprima disponibile su http://{host}:{port}/", flush=True)
+
+    def publish(self, image):
+        # Chiamato dallo stadio di visualizzazione: costa al più una copia dell'immagine
+        now = time.monotonic()
+        if self._viewers == 0 or now < self._next_frame:
+            return
+        self._next_frame = now + self._period
+
+        frame = self._pool.acquire(image.shape)
+        np.copyto(frame, image)
+        self._frames.put(frame)
+
+    def encode_loop(self):
+        while not self._closed.is_set():
+            frame = self._frames.get(timeout=0.1)
+            if frame is None:
+                continue
+
+            height, width, _ = frame.shape
+            if width > self._width:
+                preview_height = round(self._width * height / width)
+                resized = cv2.resize(frame, (self._width, preview_height),
+                                     dst=self._scratch.get("preview", (preview_height, self._width, 3)),
+                                     interpolation=cv2.INTER_AREA)
+            else:
+                resized = frame
+            _, jpeg = cv2.imencode(".jpg", resized, [cv2.IMWRITE_JPEG_QUALITY, Constants.PREVIEW_JPEG_QUALITY])
+            self._pool.release(frame)
+
+            with self._condition:
+                self._jpeg = jpeg.tobytes()
+                self._sequence += 1
+                self._condition.notify_all()
+
+    def wait_frame(self, last_sequence, timeout=1):
+        # Restituisce (jpeg, numero) del primo frame più recente di last_sequence, o (None, last_sequence) allo scadere del timeout
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._sequence > last_sequence or self._closed.is_set(), timeout):
+                return None, last_sequence
+            return self._jpeg, self._sequence
+
+    def make_handler(self):
+        preview = self
+
+        class PreviewHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/":
+                    page = b"<html><body style='margin:0;background:#000'><img src='/stream' style='width:100%'></body></html>"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/html")
+                    self.send_header("Content-Length", str(len(page)))
+                    self.end_headers()
+                    self.wfile.write(page)
+                    return
+
+                if self.path != "/stream":
+                    self.send_error(404)
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+
+                with preview._condition:
+                    preview._viewers += 1
+                sequence = 0
+                try:
+                    while not preview._closed.is_set():
+                        jpeg, sequence = preview.wait_frame(sequence)
+                        if jpeg is None:
+                            continue
+                        self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+                                         str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with preview._condition:
+                        preview._viewers -= 1
+
+            def log_message(self, format, *args):
+                # Le richieste non vengono stampate per non riempire il terminale
+                pass
+
+        return PreviewHandler
+
+    def close(self):
+        self._closed.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def publish_result(gesture_controller: GestureController, current_operation):
+    operation_to_publish = current_operation
+    if (current_operation == "Calcolando" or current_operation == "Arrivato"):
+        operation_to_publish = Command.STOP
+
+    gesture_controller._mqtt_manager.publish_operation(operation_to_publish)
+
+
+def handle_operation(gesture_controller: GestureController, image, current_operation, headless=False, stop_event=None,
+                     publish=True):
+    # Pubblico l'operazione prima di disegnare, così il comando non attende la visualizzazione (la pipeline la
+    # pubblica già sul thread di inferenza)
+    if publish:
+        publish_result(gesture_controller, current_operation)
+
+    # Scrivo l'operazione calcolata sull'immagine (se è stata disegnata), poi la invio all'anteprima e la mostro nella finestra
+    if image is not None:
+        ImageUtils.write_on_image(image, current_operation, gesture_controller._pos, gesture_controller._orient, gesture_controller._current_mode)
+        if gesture_controller._preview is not None:
+            gesture_controller._preview.publish(image)
+        if not headless:
+            ImageUtils.show_image(image)
+        gesture_controller._window_pool.release(image)
+
+    # In modalità headless non c'è nessuna finestra: si esce solo tramite segnale o se cade la connessione
+    if headless:
+        return not (stop_event is not None and stop_event.is_set()) and gesture_controller._mqtt_manager._client.is_connected()
+
+    # Gestione della chiusura della finestra
+    key = cv2.waitKey(1) & 0xFF
+    if key == 27 or cv2.getWindowProperty("Video", cv2.WND_PROP_VISIBLE) < 1 or not gesture_controller._mqtt_manager._client.is_connected():
         # if key == 27 or cv2.getWindowProperty("Video", cv2.WND_PROP_VISIBLE) < 1:
-            # Esc (27) o chiusura finestra interrompono il ciclo
-            break
+        # Esc (27) o chiusura finestra interrompono il ciclo
+        return False
+
+    return True
+
+
+def install_stop_handlers(stop_event: threading.Event):
+    # SIGINT (Ctrl+C) e SIGTERM chiudono il programma in modo ordinato, rilasciando la camera
+    def handler(signum, frame):
+        print(f"Ricevuto segnale {signal.Signals(signum).name}, chiusura in corso...", flush=True)
+        stop_event.set()
+
+    signal.signal(signal.SIGINT, handler)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Riconoscimento dei gesti per il controllo del robot")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="esegue acquisizione, inferenza e visualizzazione su thread separati")
+    parser.add_argument("--fps", type=float, default=Constants.TARGET_FPS,
+                        help="frequenza obiettivo di acquisizione dalla camera")
+    parser.add_argument("--headless", action="store_true",
+                        help="non disegna e non mostra nessuna finestra, si chiude con Ctrl+C o SIGTERM")
+    parser.add_argument("--camera", type=int, default=0,
+                        help="indice della camera da aprire")
+    parser.add_argument("--phone", action="store_true",
+                        help="la camera è uno smartphone collegato con DroidCam, le cui immagini vanno ruotate")
+    parser.add_argument("--capture-size", type=lambda value: tuple(int(side) for side in value.split("x")),
+                        default=(Constants.CAPTURE_WIDTH, Constants.CAPTURE_HEIGHT), metavar="LARGHEZZAxALTEZZA",
+                        help="risoluzione richiesta alla camera")
+    parser.add_argument("--inference-width", type=int, default=Constants.INFERENCE_WIDTH,
+                        help="larghezza dell'immagine passata a Mediapipe (0 per la risoluzione della camera)")
+    parser.add_argument("--roi", action="store_true",
+                        help="cerca la mano solo attorno alla posizione del frame precedente")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adatta complessità del modello e risoluzione di inferenza per mantenere --fps")
+    parser.add_argument("--preview", type=int, metavar="PORTA",
+                        help="invia le immagini annotate in MJPEG su http://HOST:PORTA/ (anche con --headless)")
+    parser.add_argument("--preview-host", default="127.0.0.1",
+                        help="indirizzo su cui ascolta l'anteprima (0.0.0.0 per renderla visibile in rete)")
+    parser.add_argument("--motion-gate", action="store_true",
+                        help="salta Mediapipe sui frame in cui la scena non è cambiata")
+    parser.add_argument("--record", metavar="FILE",
+                        help="registra i landmark della sessione nel file .npz indicato")
+    parser.add_argument("--record-frames", action="store_true",
+                        help="durante la registrazione salva anche i frame della camera")
+    parser.add_argument("--record-label", type=int, default=-1, metavar="DITA",
+                        help="numero di dita mostrato durante la registrazione, per addestrare il classificatore")
+    parser.add_argument("--classifier", metavar="FILE",
+                        help="conta le dita con il modello appreso salvato nel file indicato invece che con le regole geometriche")
+    parser.add_argument("--train-classifier", nargs="+", metavar=("OUTPUT", "SESSION"),
+                        help="addestra il classificatore sulle sessioni etichettate e lo salva in OUTPUT")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="riproduce una sessione registrata senza camera né broker e stampa tempi e comandi")
+    parser.add_argument("--replay-frames", action="store_true",
+                        help="durante il replay esegue di nuovo Mediapipe sui frame registrati")
+    parser.add_argument("--replay-mode", choices=[mode.name for mode in Mode],
+                        help="modalità iniziale del replay (di default quella di gesture)")
+    parser.add_argument("--direction-window", type=int, default=Constants.DIRECTION_WINDOW,
+                        help="frame su cui viene votata la direzione in modalità manuale (1 per disattivare il voto)")
+    parser.add_argument("--direction-hysteresis", type=float, default=Constants.DIRECTION_HYSTERESIS,
+                        help="gradi oltre il confine di una direzione necessari per passare a quella vicina")
+    parser.add_argument("--report", metavar="FILE",
+                        help="salva il resoconto del replay in formato JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # L'addestramento del classificatore usa solo le sessioni registrate
+    if args.train_classifier:
+        LinearClassifier.train_from_sessions(args.train_classifier[1:], args.train_classifier[0])
+        return
+
+    classifier = LinearClassifier.load(args.classifier) if args.classifier else None
+
+    # Il replay non usa né la camera né il broker
+    if args.replay:
+        report = ReplayRunner(args.replay, args.replay_frames, classifier=classifier,
+                              mode=Mode[args.replay_mode] if args.replay_mode else None,
+                              direction_filter=DirectionFilter(args.direction_window, args.direction_hysteresis)).run()
+        ReplayRunner.print_report(report)
+        if args.report:
+            with open(args.report, "w") as report_file:
+                dump(report, report_file, indent=2)
+        return
+
+    startup_start = time.monotonic()
+    is_from_phone = args.phone
+
+    # Apertura della camera e caricamento del modello (con un'inferenza di prova) avvengono su due thread,
+    # mentre il thread principale si connette al broker: l'avvio dura quanto la più lenta delle tre operazioni
+    startup = {}
+
+    def open_camera():
+        # Con DroidCam: --camera 1 --phone
+        startup["device"] = ImageUtils.open_camera(args.camera, *args.capture_size, args.fps)
+        startup["camera_s"] = time.monotonic() - startup_start
+
+    tracker = handTracker(inference_width=args.inference_width, use_roi=args.roi,
+                          motion_gate=MotionGate() if args.motion_gate else None,
+                          adaptive_fps=args.fps if args.adaptive else 0, classifier=classifier, load_model=False)
+
+    def warm_up_model():
+        width, height = args.capture_size
+        tracker.warm_up((height, width) if is_from_phone else (width, height))
+        startup["model_s"] = time.monotonic() - startup_start
+
+    startup_threads = [threading.Thread(target=open_camera), threading.Thread(target=warm_up_model)]
+    for thread in startup_threads:
+        thread.start()
+
+    # Inizializzazione gesture controller (si blocca finché il broker non è raggiungibile)
+    gesture_controller = GestureController(tracker)
+    gesture_controller._direction_filter = DirectionFilter(args.direction_window, args.direction_hysteresis)
+    broker_s = time.monotonic() - startup_start
+
+    for thread in startup_threads:
+        thread.join()
+    if "camera_s" not in startup or "model_s" not in startup:
+        raise RuntimeError("Avvio non riuscito: impossibile aprire la camera o caricare il modello")
+    device = startup["device"]
+    # Senza camera il ciclo principale leggerebbe all'infinito frame vuoti senza segnalare nulla
+    if not device.isOpened():
+        print(f"Camera {args.camera} non disponibile, uscita", flush=True)
+        raise SystemExit(1)
+    print(f"Avvio: camera {startup['camera_s']:.2f} s, modello {startup['model_s']:.2f} s, broker {broker_s:.2f} s", flush=True)
+    gesture_controller._mqtt_manager._startup_start = startup_start
+    if args.preview:
+        gesture_controller._preview = PreviewServer(args.preview, args.preview_host)
+    if args.record:
+        gesture_controller._recorder = SessionRecorder(args.record, args.record_frames, args.record_label)
+
+    stop_event = threading.Event()
+    install_stop_handlers(stop_event)
+
+    if args.pipeline:
+        GesturePipeline(device, gesture_controller, is_from_phone, args.fps, args.headless, stop_event).run()
+
+    else:
+        reader = FrameReader(device, is_from_phone)
+        rate_limiter = RateLimiter(args.fps)
+        fps_meter = FpsMeter("headless" if args.headless else "annotated")
+
+        while not stop_event.is_set():
+
+            rate_limiter.wait()
+
+            # Leggo l'immagine dalla videocamera
+            if not ImageUtils.capture_image(reader, gesture_controller, args.headless):
+                continue
+
+            # Calcolo l'operazione sulle mani
+            current_operation = gesture_controller.compute_operation()
+
+            # Pubblico l'operazione e la mostro sull'immagine
+            if not handle_operation(gesture_controller, gesture_controller._image, current_operation, args.headless, stop_event):
+                break
+
+            fps_meter.tick()
+
+    if gesture_controller._recorder is not None:
+        gesture_controller._recorder.save()
+
+    if gesture_controller._preview is not None:
+        gesture_controller._preview.close()
+
+    if tracker.motion_gate is not None:
+        print(f"Inferenze eseguite: {tracker.motion_gate.inferred}, saltate: {tracker.motion_gate.skipped}")
 
     # Rilascia la risorsa della videocamera e chiude tutte le finestre
     device.release()
-    cv2.destroyAllWindows()
+    if not args.headless:
+        cv2.destroyAllWindows()
     print("Connecting to simulator...")
     RemoteAPIClient(host="localhost").require('sim').stopSimulation()
     print("Connected to SIM and simulation stopped")
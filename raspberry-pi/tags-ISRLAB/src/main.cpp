@@ -33,68 +33,12 @@ static constexpr double rad_coeff = 180/PI;
 
 static AprilTags::TagDetector detector{AprilTags::tagCodes36h11};
 
-static std::string handleTags(const cv::Mat& image){
-
-
-	// Taglio la parte superiore dell'immagine perché non utile per il detection
-	cv::Rect roi(0, 150, width, height-150);
-	cv::Mat image_cropped = image(roi);
-
-	cv::resize(image_cropped, image_cropped, cv::Size(), 0.5, 0.5);
-
-	// Eseguo uno sharpening per migliorare la qualità dei contorni
-	
-	cv::Mat filter = (cv::Mat_<double>(3,3) << -0.5, -0.5,-0.5,-0.5,5,-0.5,-0.5,-0.5,-0.5);
-	
-	cv::filter2D(image_cropped, image_cropped, -1, filter);
-	
-	// Converto l'immagine in scala di grigi
-	cv::Mat image_gray{};
-	cv::cvtColor(image_cropped, image_gray, cv::COLOR_BGR2GRAY);
-
-	// Eseguo un thresholding binario sull'immagine 
-	cv::Mat thresholded_image_gray;
-	cv::threshold(image_gray, thresholded_image_gray, 110, 255, cv::THRESH_BINARY);
-	
-	// Eseguo la detection sull'immagine binaria
-	auto detections = detector.extractTags(thresholded_image_gray);
-
-
-	// Se non ho trovato tag restituisco un tag vuoto
-	if(detections.size() == 0) {
-		// Se non trovo tag, stampo l'immagine senza linee
-		std::thread t([thresholded_image_gray](){ cv::imwrite("result.png", thresholded_image_gray); });
-		t.detach();
-
-		return boost::json::serialize(boost::json::value{
-			{"ID", -1},
-			{"dist", 0},
-			{"yaw", 0},
-			{"phi", 0},
-		});
-	}
-	
-	
-	// Per il calcolo della posizione mi basta solo il primo tag che vedo. 
-	const AprilTags::TagDetection& detection = detections[0];
+// Calcola distanza, yaw e phi di un singolo tag rilevato in un'immagine di dimensioni width x height
+static boost::json::object tagToJson(const AprilTags::TagDetection& detection, int width, int height){
 
-	cv::Mat colored_with_lines_on_tag;
-	cv::cvtColor(thresholded_image_gray, colored_with_lines_on_tag, cv::COLOR_GRAY2BGR);
-	cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[0].first, detection.p[0].second }, cv::Point2f{detection.p[1].first, detection.p[1].second },{0,255,0}, 2);
-	cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[1].first, detection.p[1].second }, cv::Point2f{detection.p[2].first, detection.p[2].second },{0,255,0}, 2);
-	cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[2].first, detection.p[2].second }, cv::Point2f{detection.p[3].first, detection.p[3].second },{0,255,0}, 2);
-	cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[3].first, detection.p[3].second }, cv::Point2f{detection.p[0].first, detection.p[0].second },{0,255,0}, 2);
-
-	// Stampo l'immagine binaria
-	std::thread t([colored_with_lines_on_tag](){ cv::imwrite("result.png", colored_with_lines_on_tag); });
-	t.detach();
-	
-	
 	Eigen::Vector3d translation{};
 	Eigen::Matrix3d rotation{};
 
-	int width = thresholded_image_gray.size().width;
-	int height = thresholded_image_gray.size().height;
 	double f = (width/2) / 0.6032; //tan(31.1°);
 	
 
@@ -162,15 +106,78 @@ static std::string handleTags(const cv::Mat& image){
 	double yaw = yaw_sign * angolo_gradi;
 
 
-	boost::json::value json_tag = {
+	return boost::json::object{
 		{"ID", detection.id},
 		{"dist", dist},
 		{"yaw", yaw},
 		{"phi", phi},
 	};
+}
+
+static std::string handleTags(const cv::Mat& image){
+
+
+	// Taglio la parte superiore dell'immagine perché non utile per il detection
+	cv::Rect roi(0, 150, width, height-150);
+	cv::Mat image_cropped = image(roi);
+
+	cv::resize(image_cropped, image_cropped, cv::Size(), 0.5, 0.5);
+
+	// Eseguo uno sharpening per migliorare la qualità dei contorni
+	
+	cv::Mat filter = (cv::Mat_<double>(3,3) << -0.5, -0.5,-0.5,-0.5,5,-0.5,-0.5,-0.5,-0.5);
 	
+	cv::filter2D(image_cropped, image_cropped, -1, filter);
+	
+	// Converto l'immagine in scala di grigi
+	cv::Mat image_gray{};
+	cv::cvtColor(image_cropped, image_gray, cv::COLOR_BGR2GRAY);
+
+	// Eseguo un thresholding binario sull'immagine 
+	cv::Mat thresholded_image_gray;
+	cv::threshold(image_gray, thresholded_image_gray, 110, 255, cv::THRESH_BINARY);
+	
+	// Eseguo la detection sull'immagine binaria
+	auto detections = detector.extractTags(thresholded_image_gray);
+
+
+	// Se non ho trovato tag restituisco una lista vuota
+	if(detections.size() == 0) {
+		// Se non trovo tag, stampo l'immagine senza linee
+		std::thread t([thresholded_image_gray](){ cv::imwrite("result.png", thresholded_image_gray); });
+		t.detach();
+
+		return boost::json::serialize(boost::json::object{
+			{"tags", boost::json::array{}},
+		});
+	}
+
+
+	// Pubblico tutti i tag visti nel frame: il controller combina le stime di ognuno per calcolare la posizione
+	cv::Mat colored_with_lines_on_tag;
+	cv::cvtColor(thresholded_image_gray, colored_with_lines_on_tag, cv::COLOR_GRAY2BGR);
+
+	int width = thresholded_image_gray.size().width;
+	int height = thresholded_image_gray.size().height;
+
+	boost::json::array json_tags;
+	for(const AprilTags::TagDetection& detection : detections) {
+		cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[0].first, detection.p[0].second }, cv::Point2f{detection.p[1].first, detection.p[1].second },{0,255,0}, 2);
+		cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[1].first, detection.p[1].second }, cv::Point2f{detection.p[2].first, detection.p[2].second },{0,255,0}, 2);
+		cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[2].first, detection.p[2].second }, cv::Point2f{detection.p[3].first, detection.p[3].second },{0,255,0}, 2);
+		cv::line(colored_with_lines_on_tag, cv::Point2f{detection.p[3].first, detection.p[3].second }, cv::Point2f{detection.p[0].first, detection.p[0].second },{0,255,0}, 2);
+
+		json_tags.push_back(tagToJson(detection, width, height));
+	}
+
+	// Stampo l'immagine binaria
+	std::thread t([colored_with_lines_on_tag](){ cv::imwrite("result.png", colored_with_lines_on_tag); });
+	t.detach();
+
 	// Pubblico il messaggio creato
-	return boost::json::serialize(json_tag);
+	return boost::json::serialize(boost::json::object{
+		{"tags", json_tags},
+	});
 
 }
 